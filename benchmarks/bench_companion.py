@@ -0,0 +1,241 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+# Companion watchdog benchmark, in three parts:
+#     tear:   a child process publishes the shared state as fast as it can, with every field set to the same counter,
+#             while this process reads it. Any read where the fields don't all match would be a torn read
+#     freeze: a child process publishes two heaters that are turned on, the way the plugin does, and the companion
+#             watchdog runs in another. The publisher is frozen with SIGSTOP, and the time until the companion
+#             reports the stall on its socket is measured
+#     disconnect: the same, but the publisher disarms the state the way the plugin does when the printer is
+#             disconnected and stops publishing reports. Neither that nor freezing it afterwards should be reported
+#
+# Run from the repository root with:
+#     python -m benchmarks.bench_companion [--seconds 2] [--stall 2]
+
+import argparse
+import json
+import logging
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from octoprint_ThermalRunaway.engine import MonitorEngine
+from octoprint_ThermalRunaway.settings import build_snapshot_from_dict
+from octoprint_ThermalRunaway.sharedstate import StatePublisher, StateReader
+
+
+class CounterHeater(object):
+    # Just enough of a heater for StatePublisher.publish, with every value set to the same counter
+    __slots__ = ('name', 'received', 'current', 'set', 'warningLow', 'warningHigh', 'rateWarning', 'modelWarning',
+                 'tripped')
+
+    def __init__(self, name):
+        self.name = name
+        self.received = self.current = self.set = 0.0
+        self.warningLow = self.warningHigh = self.rateWarning = self.modelWarning = self.tripped = False
+
+
+# Run in the child for the tear test, publishes until it is killed
+def write_counter(path):
+    publisher = StatePublisher(path, logging.getLogger('bench'), heartbeatInterval=0.01)
+    publisher.start()
+    heaters = [CounterHeater(name) for name in ('B', 'C', 'T0', 'T1', 'T2', 'T3')]
+    counter = 0.0
+    # Publish once before saying we're ready, until then the heartbeat thread writes a state with no heaters in it
+    publisher.publish(heaters)
+    print('ready', flush=True)
+    while True:
+        counter += 1.0
+        for heater in heaters:
+            heater.received = heater.current = heater.set = counter
+        publisher.publish(heaters)
+
+
+# Run in the child for the freeze and disconnect tests, reports two heaters holding temperature twice a second until
+# it is killed. With disconnect, the printer is disconnected after a few reports and only the heartbeat carries on
+def publish_heaters(path, disconnect=False):
+    engine = MonitorEngine(build_snapshot_from_dict(), logging.getLogger('bench'), lambda *args: None)
+    publisher = StatePublisher(path, logging.getLogger('bench'))
+    publisher.start()
+    print('ready', flush=True)
+    reports = 0
+    while True:
+        now = time.time()
+        if disconnect and reports == 4:
+            publisher.disarm()
+        elif reports < 4 or not disconnect:
+            engine.evaluate({'T0': (210.0, 210.0, now), 'B': (60.0, 60.0, now)})
+            publisher.publish(engine.heaters)
+        reports += 1
+        time.sleep(0.5)
+
+
+def start_child(mode, path):
+    child = subprocess.Popen([sys.executable, "-m", "benchmarks.bench_companion", "--child", mode, path],
+                             stdout=subprocess.PIPE)
+    child.stdout.readline()
+    return child
+
+
+def stop_child(child):
+    try:
+        child.send_signal(signal.SIGCONT)
+    except OSError:
+        pass
+    child.kill()
+    child.wait()
+
+
+def tear_test(folder, seconds):
+    path = os.path.join(folder, 'tear.state')
+    child = start_child('writer', path)
+    reader = StateReader(path)
+    torn = 0
+    counters = set()
+    try:
+        started = time.perf_counter()
+        while time.perf_counter() - started < seconds:
+            state = reader.read()
+            if state is None or not state.heaters:
+                # Not written yet, or only the heartbeat from before the first publish
+                continue
+            values = set()
+            for heater in state.heaters:
+                values.update((heater.received, heater.current, heater.set))
+            if len(values) != 1 or len(state.heaters) != 6:
+                torn += 1
+            counters.update(values)
+        elapsed = time.perf_counter() - started
+    finally:
+        stop_child(child)
+        reader.close()
+    print("tear:   {} reads ({:.0f}/s) of {} different states, {} retried, {} torn".format(
+        reader.reads, reader.reads / elapsed, len(counters), reader.retries, torn))
+    return torn == 0 and reader.reads > 0
+
+
+def start_companion(path, socketPath, stall, *arguments):
+    return subprocess.Popen([sys.executable, "-m", "octoprint_ThermalRunaway.companion", "--state", path,
+                             "--stall", str(stall), "--interval", "0.1", "--socket", socketPath] + list(arguments))
+
+
+def listen(socketPath):
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socketPath)
+    server.listen(1)
+    return server
+
+
+def freeze_test(folder, stall):
+    path = os.path.join(folder, 'freeze.state')
+    socketPath = os.path.join(folder, 'companion.sock')
+    server = listen(socketPath)
+
+    publisher = start_child('publisher', path)
+    companion = start_companion(path, socketPath, stall)
+    try:
+        # Nothing should be reported while the publisher is running
+        server.settimeout(stall + 1.0)
+        try:
+            server.accept()
+            print("freeze: the companion reported an emergency while the publisher was running")
+            return False
+        except socket.timeout:
+            pass
+
+        publisher.send_signal(signal.SIGSTOP)
+        frozen = time.time()
+        server.settimeout(stall + 5.0)
+        try:
+            connection, address = server.accept()
+        except socket.timeout:
+            print("freeze: the companion didn't report the publisher freezing")
+            return False
+        caught = time.time() - frozen
+        connection.settimeout(1.0)
+        event = json.loads(connection.makefile().readline())
+        connection.close()
+    finally:
+        stop_child(publisher)
+        companion.kill()
+        companion.wait()
+        server.close()
+
+    # The heartbeat is written once a second and the companion reads every 0.1s, so the stall is caught at most
+    # about 1.1s after the stall time has passed from the freeze
+    print("freeze: {} on {} (set {}) caught {:.2f}s after freezing the publisher, stall time {}s".format(
+        event['event'], event['heater'], event['set'], caught, stall))
+    return event['event'] == 'stalled' and caught <= stall + 1.5
+
+
+def disconnect_test(folder, stall):
+    path = os.path.join(folder, 'disconnect.state')
+    socketPath = os.path.join(folder, 'disconnect.sock')
+    server = listen(socketPath)
+
+    publisher = start_child('disconnect', path)
+    # Act on the reports stopping, and after only a second, so that a disconnect taken for a stall would be reported
+    companion = start_companion(path, socketPath, stall, "--set", "staleAction=emergency", "--set", "staleTimeout=1")
+    try:
+        # The publisher disconnects after 2 seconds, wait long enough for the reports to have gone stale after that
+        server.settimeout(stall + 3.0)
+        try:
+            server.accept()
+            print("disconnect: the companion reported an emergency after the printer was disconnected")
+            return False
+        except socket.timeout:
+            pass
+
+        # OctoPrint hanging while the printer is disconnected isn't a stall with a heater on either
+        publisher.send_signal(signal.SIGSTOP)
+        server.settimeout(stall + 2.0)
+        try:
+            server.accept()
+            print("disconnect: the companion reported an emergency after freezing the disconnected publisher")
+            return False
+        except socket.timeout:
+            pass
+    finally:
+        stop_child(publisher)
+        companion.kill()
+        companion.wait()
+        server.close()
+
+    print("disconnect: nothing reported after disconnecting and then freezing the publisher")
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Shared state and companion watchdog benchmark")
+    parser.add_argument("--seconds", type=float, default=2.0, help="how long to read for in the tear test")
+    parser.add_argument("--stall", type=float, default=2.0, help="stall time given to the companion")
+    parser.add_argument("--child", nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        mode, path = args.child
+        if mode == 'writer':
+            write_counter(path)
+        else:
+            publish_heaters(path, disconnect=mode == 'disconnect')
+        return 0
+
+    folder = tempfile.mkdtemp(prefix='thermalrunaway-bench-')
+    try:
+        results = [tear_test(folder, args.seconds), freeze_test(folder, args.stall),
+                   disconnect_test(folder, args.stall)]
+    finally:
+        for name in os.listdir(folder):
+            os.remove(os.path.join(folder, name))
+        os.rmdir(folder)
+    print("ok" if all(results) else "FAILED")
+    return 0 if all(results) else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
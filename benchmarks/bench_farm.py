@@ -0,0 +1,67 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+# Scaling benchmark for FarmMonitor: how many heater readings per second one process can check as the number of
+# printers goes up. Every printer is fed from its own asyncio source, the way a farm would be fed from its printers'
+# connections, and each report is a steady state report so the numbers are for the common case.
+#
+# Run from the repository root with:
+#     python -m benchmarks.bench_farm [--printers 1,10,100,500] [--reports N] [--extruders N] [--parse]
+#
+# --parse feeds each printer M105 response lines instead of parsed reports, so the time includes parsing them
+
+import argparse
+import asyncio
+import logging
+import time
+
+from octoprint_ThermalRunaway.engine import FarmMonitor
+from octoprint_ThermalRunaway.parsing import parse_temperature_line
+
+from .stubs import make_snapshot
+
+
+# An async source of steady state reports for one printer, yielding to the event loop after every report
+async def report_source(reports, extruders, lines):
+    temps = {'B': (60.0, 60.0)}
+    for extruder in range(0, extruders):
+        temps['T{}'.format(extruder)] = (210.0, 210.0)
+    line = 'ok ' + ' '.join('{}:{} /{}'.format(heater, values[0], values[1]) for heater, values in temps.items())
+    for t in range(0, reports):
+        yield line if lines else (float(t), temps)
+        await asyncio.sleep(0)
+
+
+def run_farm(printers, reports, extruders, lines):
+    farm = FarmMonitor(make_snapshot(), logging.getLogger('bench_farm'))
+    sources = dict(('printer{}'.format(printer), report_source(reports, extruders, lines))
+                   for printer in range(0, printers))
+    started = time.perf_counter()
+    counts = asyncio.run(farm.run(sources, parse_temperature_line if lines else None))
+    elapsed = time.perf_counter() - started
+    return sum(counts.values()), elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Heater readings per second checked by FarmMonitor vs printers")
+    parser.add_argument("--printers", default="1,10,100,500", help="comma separated printer counts to run")
+    parser.add_argument("--reports", type=int, default=200, help="reports per printer")
+    parser.add_argument("--extruders", type=int, default=1)
+    parser.add_argument("--parse", action="store_true", help="feed M105 lines and include the time to parse them")
+    args = parser.parse_args()
+
+    # Nothing goes wrong in a steady state, keep the debug logging out of the timings
+    logging.basicConfig(level=logging.WARNING)
+    heatersPerReport = args.extruders + 1
+
+    print("{:>9} {:>10} {:>10} {:>14} {:>12}".format("printers", "reports", "seconds", "heaters/sec", "us/heater"))
+    for printers in [int(count) for count in args.printers.split(',')]:
+        reports, elapsed = run_farm(printers, args.reports, args.extruders, args.parse)
+        heaters = reports * heatersPerReport
+        print("{:>9} {:>10} {:>10.3f} {:>14.0f} {:>12.2f}".format(printers, reports, elapsed, heaters / elapsed,
+                                                                elapsed / heaters * 1e6))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,86 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+# Benchmark for the serial.log parser and replay. Writes a synthetic serial.log of the requested size (a print with
+# the usual mix of sent G-code, oks and a temperature report every second, with the hotend running away near the
+# end), then times parsing it on its own and replaying it through the engine, and checks the runaway is found.
+#
+# Run from the repository root with:
+#     python -m benchmarks.bench_serial_log [--megabytes N] [--keep PATH]
+
+import argparse
+import logging
+import os
+import tempfile
+import time
+import tracemalloc
+
+from octoprint_ThermalRunaway.replay import replay_log
+
+START = time.mktime((2023, 5, 1, 12, 0, 0, 0, 0, -1))
+
+
+def _timestamp(seconds):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(seconds)) + ',{:03d}'.format(int(seconds % 1 * 1000))
+
+
+# Write a log of about megabytes MB. The hotend starts climbing away from its set temp 60 reports from the end
+def write_log(path, megabytes):
+    target = megabytes * 1024 * 1024
+    lines = int(target / 60)  # Lines are about 60 bytes on average
+    reports = lines // 20
+    written = 0
+    with open(path, 'w') as log:
+        for report in range(0, reports):
+            now = START + report
+            stamp = _timestamp(now)
+            tool = 210.0 + (report % 3 - 1) * 0.3
+            if report > reports - 60:
+                tool += (report - (reports - 60)) * 2.0
+            log.write('{} - Recv: ok T:{:.1f} /210.0 B:60.0 /60.0 @:64 B@:12\n'.format(stamp, tool))
+            for line in range(0, 9):
+                log.write('{} - Send: N{} G1 X{:.3f} Y{:.3f} E0.0421*85\n'.format(stamp, report * 9 + line,
+                                                                                    line * 1.1, line * 2.3))
+                log.write('{} - Recv: ok\n'.format(stamp))
+            written = log.tell()
+            if written >= target:
+                break
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput of the serial.log parser and replay")
+    parser.add_argument("--megabytes", type=int, default=200)
+    parser.add_argument("--keep", help="write the log here and keep it, instead of a temporary file")
+    args = parser.parse_args()
+
+    # Only the summary is wanted, not the engine's warnings
+    logging.getLogger('octoprint.plugins.ThermalRunaway.replay').setLevel(logging.CRITICAL + 1)
+
+    path = args.keep or tempfile.mkstemp(prefix='serial', suffix='.log')[1]
+    try:
+        size = write_log(path, args.megabytes) / 1024.0 / 1024.0
+        parsed = replay_log(path, parseOnly=True)
+        replayed = replay_log(path)
+        # Memory allocated by the parser, not counting the mapped log which the OS pages in and out as needed
+        tracemalloc.start()
+        replay_log(path, parseOnly=True)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    finally:
+        if not args.keep:
+            os.remove(path)
+
+    print("log size:      {:.1f} MB, {} temperature reports".format(size, parsed['reports']))
+    print("parse only:    {:.2f} s ({:.0f} MB/s, {:.0f} reports/s)".format(
+        parsed['parseSeconds'], size / parsed['parseSeconds'], parsed['reports'] / parsed['parseSeconds']))
+    print("parse+replay:  {:.2f} s parsing, {:.2f} s replaying ({:.0f} reports/s)".format(
+        replayed['parseSeconds'], replayed['replaySeconds'], replayed['reports'] / replayed['replaySeconds']))
+    print("parser memory: {:.1f} MB peak".format(peak / 1024.0 / 1024.0))
+    print("runaways:      {}".format(', '.join('{} {}'.format(runaway['heater'], runaway['type'])
+                                               for runaway in replayed['runaways']) or 'none'))
+    return 0 if [runaway['heater'] for runaway in replayed['runaways']] == ['T0'] else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,79 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+# Micro-benchmark for the settings lookups done on every temperature report
+#
+# Run from the repository root with:
+#     python -m benchmarks.bench_settings [--extruders N] [--reports N]
+
+import argparse
+import time
+import timeit
+
+from .stubs import make_plugin, close_plugin
+
+
+# The settings reads check_temps used to do on every report, before the settings snapshot
+def legacy_settings_reads(settings, extruderCount):
+    values = [settings.get(["emergencyGcode"]),
+              float(settings.get(["bDelay"])),
+              float(settings.get(["bMaxDiff"])),
+              float(settings.get(["bMaxOffTemp"]))]
+    for extruder in range(0, extruderCount):
+        values.append(float(settings.get(["tDelay"])))
+        values.append(float(settings.get(["tMaxDiff"])))
+        values.append(float(settings.get(["tMaxOffTemp"])))
+    return values
+
+
+# The same values read from the settings snapshot
+def snapshot_settings_reads(snapshot, extruderCount):
+    values = [snapshot.emergencyGcode,
+              snapshot.bed.delay,
+              snapshot.bed.maxDiff,
+              snapshot.bed.maxOffTemp]
+    for extruder in range(0, extruderCount):
+        values.append(snapshot.tool.delay)
+        values.append(snapshot.tool.maxDiff)
+        values.append(snapshot.tool.maxOffTemp)
+    return values
+
+
+def per_call_us(func, number):
+    return min(timeit.repeat(func, number=number, repeat=5)) / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-report cost of the ThermalRunaway settings lookups")
+    parser.add_argument("--extruders", type=int, default=1)
+    parser.add_argument("--reports", type=int, default=20000)
+    args = parser.parse_args()
+
+    plugin = make_plugin()
+    plugin.initialize()
+    plugin.evaluationWorker.stop()
+    settings = plugin._settings
+    snapshot = plugin.settingsSnapshot
+
+    before = per_call_us(lambda: legacy_settings_reads(settings, args.extruders), args.reports)
+    after = per_call_us(lambda: snapshot_settings_reads(snapshot, args.extruders), args.reports)
+
+    # Time the whole of check_temps and make sure it doesn't touch the settings at all
+    now = time.time()
+    report = {'B': (60.0, 60.0, now)}
+    for extruder in range(0, args.extruders):
+        report['T{}'.format(extruder)] = (210.0, 210.0, now)
+    settings.calls = 0
+    full = per_call_us(lambda: plugin.check_temps(report), args.reports)
+    close_plugin(plugin)
+
+    print("extruders:                       {}".format(args.extruders))
+    print("settings reads per report:       before {:.2f} us, after {:.2f} us ({:.1f}x)"
+          .format(before, after, before / after))
+    print("check_temps per report:          {:.2f} us".format(full))
+    print("settings.get calls in check_temps: {}".format(settings.calls))
+    return 0 if settings.calls == 0 else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
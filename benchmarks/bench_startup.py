@@ -0,0 +1,76 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+# Startup benchmark: how long the plugin takes to import and initialise, and how long after that the first
+# temperature report is evaluated. Each run is a fresh interpreter, with OctoPrint, flask and logging imported
+# beforehand the way they are by the time OctoPrint loads its plugins, so the import time is the plugin's own.
+#
+# Run from the repository root with:
+#     python -m benchmarks.bench_startup [--runs N]
+
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+
+# Run in the child interpreter, prints the timings as JSON
+def measure():
+    import logging  # noqa: F401
+    import octoprint.plugin  # noqa: F401
+    import octoprint.access.permissions  # noqa: F401
+    import flask  # noqa: F401
+    before = set(sys.modules)
+
+    started = time.perf_counter()
+    import octoprint_ThermalRunaway.plugin
+    imported = time.perf_counter() - started
+    modules = sorted(name for name in set(sys.modules) - before if not name.startswith('octoprint_ThermalRunaway'))
+
+    from .stubs import make_plugin, close_plugin
+    plugin = make_plugin()
+    started = time.perf_counter()
+    plugin.initialize()
+    initialised = time.perf_counter() - started
+
+    # First report, as OctoPrint would hand it over straight after the printer connects
+    started = time.perf_counter()
+    plugin.get_temps(None, {'T0': (25.0, 0.0), 'B': (25.0, 0.0)})
+    while not plugin.evaluationWorker.evaluated:
+        time.sleep(0)
+    firstReport = time.perf_counter() - started
+    close_plugin(plugin)
+
+    print(json.dumps(dict(importSeconds=imported, pluginImportSeconds=octoprint_ThermalRunaway.plugin.IMPORT_SECONDS,
+                          initSeconds=initialised, firstReportSeconds=firstReport, modules=modules)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import and initialisation time of the ThermalRunaway plugin")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        measure()
+        return 0
+
+    runs = []
+    for run in range(0, args.runs):
+        output = subprocess.check_output([sys.executable, "-m", "benchmarks.bench_startup", "--child"])
+        runs.append(json.loads(output.decode().strip().splitlines()[-1]))
+
+    def summary(key):
+        values = sorted(run[key] * 1000 for run in runs)
+        return "median {:7.2f} ms, max {:7.2f} ms".format(values[len(values) // 2], values[-1])
+
+    print("import:         {}".format(summary('importSeconds')))
+    print("initialise:     {}".format(summary('initSeconds')))
+    print("first report:   {}  (from get_temps to evaluated)".format(summary('firstReportSeconds')))
+    print("modules loaded: {}".format(', '.join(runs[-1]['modules']) or 'none'))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,317 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+# Benchmark and replay harness for ThermalRunawayPlugin
+#
+# Drives the plugin outside of OctoPrint with synthetic temperature streams and reports throughput, per-report
+# latency and time-to-detection for each scenario. Exits with a non-zero status if a scenario is detected when it
+# shouldn't be, isn't detected in time, or the latency/throughput limits given on the command line are not met,
+# so it can be used in CI.
+#
+# Run from the repository root with:
+#     python -m benchmarks.harness [--scenario NAME] [--extruders N] [--max-p99-us N] [--min-reports-per-sec N]
+#                                  [--max-emergency-us N] [--predictive]
+#     python -m benchmarks.harness --replay stream.jsonl
+#
+# A replay file has one JSON object per line: {"t": <seconds>, "temps": {"T0": [current, set], "B": [current, set]}}
+# A line with "temps": null is a second in which no report arrived
+
+import argparse
+import json
+import logging
+import math
+import random
+import time
+
+from .stubs import StubComm, make_plugin, close_plugin
+
+AMBIENT = 25.0
+# Scenario times are in seconds from the start of the stream, the reports are timestamped from this epoch the way
+# OctoPrint's would be. Starting from 0 would hide anything on the first report, a time of 0 means "not yet" in the
+# engine
+EPOCH = 1700000000.0
+
+
+class Scenario(object):
+    # A synthetic temperature stream, and what the plugin is expected to make of it
+    def __init__(self, name, description, generate, expected=None, faultAt=None, deadline=None, overrides=None):
+        self.name = name
+        self.description = description
+        # generate(extruders, seed) -> iterable of (time, {heater: (current, set)}), with None instead of the temps
+        # for a time at which no report arrives
+        self.generate = generate
+        self.expected = expected  # None if no runaway should be caught, otherwise 'over', 'under' or 'stale'
+        self.faultAt = faultAt  # Time in the stream that the fault starts
+        self.deadline = deadline  # Maximum allowed seconds from faultAt to detection
+        self.overrides = overrides  # Settings to run the scenario with, on top of the defaults
+
+
+# Build a report with every heater sitting at its set temp, plus whatever the scenario overrides
+def _report(extruders, bed, tool, overrides=None):
+    temps = {'B': bed}
+    for extruder in range(0, extruders):
+        temps['T{}'.format(extruder)] = tool
+    if overrides:
+        temps.update(overrides)
+    return temps
+
+
+def steady_state(extruders, seed, duration=600):
+    for t in range(0, duration):
+        yield float(t), _report(extruders, (60.0, 60.0), (210.0, 210.0))
+
+
+def heat_up(extruders, seed, duration=600):
+    # Tool heats at 2C/s and the bed at 0.5C/s from ambient, then both hold at the set temp
+    for t in range(0, duration):
+        tool = min(210.0, AMBIENT + 2.0 * t)
+        bed = min(60.0, AMBIENT + 0.5 * t)
+        yield float(t), _report(extruders, (bed, 60.0), (tool, 210.0))
+
+
+def thermistor_dropout(extruders, seed, duration=300, faultAt=120):
+    # T0's thermistor disconnects and reads a constant -14C
+    for t in range(0, duration):
+        overrides = {'T0': (-14.0, 210.0)} if t >= faultAt else None
+        yield float(t), _report(extruders, (60.0, 60.0), (210.0, 210.0), overrides)
+
+
+def heater_stuck_on(extruders, seed, duration=300, faultAt=120):
+    # T0's heater stays on at full power and the temperature keeps climbing at 1.5C/s
+    for t in range(0, duration):
+        overrides = {'T0': (210.0 + 1.5 * (t - faultAt), 210.0)} if t >= faultAt else None
+        yield float(t), _report(extruders, (60.0, 60.0), (210.0, 210.0), overrides)
+
+
+def heater_failure(extruders, seed, duration=300, faultAt=40):
+    # T0 heats at 2C/s from ambient until its heater cartridge falls out, after which it slowly cools
+    for t in range(0, duration):
+        if t < faultAt:
+            tool = AMBIENT + 2.0 * t
+        else:
+            tool = AMBIENT + 2.0 * faultAt - 0.2 * (t - faultAt)
+        yield float(t), _report(extruders, (60.0, 60.0), (min(210.0, AMBIENT + 2.0 * t), 210.0),
+                                {'T0': (tool, 210.0)})
+
+
+def cartridge_loose(extruders, seed, duration=300, faultAt=150):
+    # T0 heats up and holds its set temp with a little sensor noise, then its heater cartridge slips out of the block
+    # and the block cools towards ambient
+    rng = random.Random(seed)
+    for t in range(0, duration):
+        if t < faultAt:
+            tool = min(210.0, AMBIENT + 2.0 * t)
+        else:
+            tool = AMBIENT + (210.0 - AMBIENT) * math.exp(-(t - faultAt) / 120.0)
+        yield float(t), _report(extruders, (60.0, 60.0), (min(210.0, AMBIENT + 2.0 * t), 210.0),
+                                {'T0': (tool + rng.uniform(-0.3, 0.3), 210.0)})
+
+
+def chamber_stuck_on(extruders, seed, duration=400, faultAt=120):
+    # The chamber heater stays on and the chamber keeps warming at 0.3C/s, some reports leave the bed out
+    for t in range(0, duration):
+        chamber = 45.0 + 0.3 * (t - faultAt) if t >= faultAt else 45.0
+        temps = _report(extruders, (60.0, 60.0), (210.0, 210.0), {'C': (chamber, 45.0)})
+        if t % 7 == 0:
+            del temps['B']
+        yield float(t), temps
+
+
+def reports_stop(extruders, seed, duration=300, faultAt=120):
+    # The printer stops reporting while every heater is holding its set temp, as if the serial link had stalled
+    for t in range(0, duration):
+        yield float(t), _report(extruders, (60.0, 60.0), (210.0, 210.0)) if t < faultAt else None
+
+
+def noisy_sensor(extruders, seed, duration=600):
+    # Every heater reads +/- 4C of noise around its set temp, well inside the allowed difference
+    rng = random.Random(seed)
+    for t in range(0, duration):
+        yield float(t), _report(extruders,
+                                (60.0 + rng.uniform(-4.0, 4.0), 60.0),
+                                (210.0 + rng.uniform(-4.0, 4.0), 210.0))
+
+
+SCENARIOS = [
+    Scenario('steady', 'All heaters holding their set temp', steady_state),
+    Scenario('heatup', 'Heat-up ramp from ambient to the set temp', heat_up),
+    Scenario('dropout', 'T0 thermistor disconnected', thermistor_dropout,
+             expected='under', faultAt=120, deadline=10),
+    Scenario('stuck_on', 'T0 heater stuck on', heater_stuck_on,
+             expected='over', faultAt=120, deadline=20),
+    Scenario('failure', 'T0 heater cartridge falls out while heating up', heater_failure,
+             expected='under', faultAt=40, deadline=20),
+    Scenario('cartridge', 'T0 heater cartridge slips out while holding its set temp', cartridge_loose,
+             expected='under', faultAt=150, deadline=12, overrides={'predictiveDetection': True}),
+    Scenario('chamber', 'Chamber heater stuck on, bed missing from some reports', chamber_stuck_on,
+             expected='over', faultAt=120, deadline=60, overrides={'chamberMonitoring': True}),
+    Scenario('stalled', 'Temperature reports stop while heating', reports_stop,
+             expected='stale', faultAt=120, deadline=62, overrides={'staleAction': 'emergency'}),
+    Scenario('noisy', 'Noisy sensors around the set temp', noisy_sensor),
+]
+
+
+# Load a recorded stream for --replay
+def load_stream(path):
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            temps = record['temps']
+            yield float(record['t']), None if temps is None else dict((heater, tuple(values))
+                                                                      for heater, values in temps.items())
+
+
+def percentile(sortedValues, fraction):
+    if not sortedValues:
+        return float('NaN')
+    index = min(len(sortedValues) - 1, int(round(fraction * (len(sortedValues) - 1))))
+    return sortedValues[index]
+
+
+# Feed a stream through a fresh plugin and collect timings and detections
+def run_stream(stream, overrides=None, epoch=0.0):
+    plugin = make_plugin(overrides=overrides)
+    plugin.initialize()
+    # Evaluate on this thread so that the timings and detections are deterministic, and run the watchdog's checks on
+    # the stream's clock rather than the real one
+    plugin.evaluationWorker.stop()
+    plugin.staleWatchdog.stop()
+    # The comm object OctoPrint would pass along with the temperature reports, the emergency GCode goes straight to it
+    comm = plugin.emergencyAction.comm = StubComm()
+    # Firmware that can auto report its temps, so that the reports are sped up during warnings
+    plugin.firmware_capability(comm, "AUTOREPORT_TEMP", True, {})
+
+    latencies = []
+    detections = []
+    fired = 0
+    clock = time.perf_counter
+    started = clock()
+    for t, temps in stream:
+        if temps is not None:
+            report = dict((heater, (values[0], values[1], epoch + t)) for heater, values in temps.items())
+            before = clock()
+            plugin.check_temps(report)
+            latencies.append(clock() - before)
+        plugin.staleWatchdog.check(epoch + t)
+        if plugin.emergencyAction.fired != fired:
+            fired = plugin.emergencyAction.fired
+            detections.append(t)
+    elapsed = clock() - started
+    close_plugin(plugin)
+
+    latencies.sort()
+    return {
+        'reports': len(latencies),
+        'reportsPerSec': len(latencies) / elapsed if elapsed > 0 else float('inf'),
+        'p50us': percentile(latencies, 0.50) * 1e6,
+        'p90us': percentile(latencies, 0.90) * 1e6,
+        'p99us': percentile(latencies, 0.99) * 1e6,
+        'maxus': latencies[-1] * 1e6 if latencies else float('NaN'),
+        'detections': detections,
+        'messages': len(plugin._plugin_manager.messages),
+        'emergencyMaxus': plugin.emergencyAction.latency.max * 1e6 if fired else None,
+        'commands': [command for command, sentAt in comm.sent] + list(plugin._printer.sent),
+    }
+
+
+# Check a scenario's result against what was expected, returns a list of problems
+def check_scenario(scenario, result):
+    problems = []
+    detections = result['detections']
+    if scenario.expected is None:
+        if detections:
+            problems.append('false runaway at t={}'.format(detections[0]))
+        # Nothing in these should be a warning worth speeding the temperature reports up for
+        speedUps = [command for command in result['commands'] if command.startswith('M155')]
+        if speedUps:
+            problems.append('temperature reports sped up with no fault ({})'.format(', '.join(speedUps)))
+        return problems, None
+
+    early = [t for t in detections if t < scenario.faultAt]
+    if early:
+        problems.append('runaway caught before the fault at t={}'.format(early[0]))
+    late = [t for t in detections if t >= scenario.faultAt]
+    if not late:
+        problems.append('runaway not detected')
+        return problems, None
+    timeToDetection = late[0] - scenario.faultAt
+    if len(late) > 1:
+        problems.append('emergency action sent {} times for one runaway'.format(len(late)))
+    if scenario.deadline is not None and timeToDetection > scenario.deadline:
+        problems.append('detected after {}s, deadline is {}s'.format(timeToDetection, scenario.deadline))
+    return problems, timeToDetection
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark and replay harness for the ThermalRunaway plugin")
+    parser.add_argument("--scenario", action="append", choices=[s.name for s in SCENARIOS],
+                        help="Scenario to run, can be given more than once. Defaults to all of them")
+    parser.add_argument("--replay", help="Replay a recorded stream instead of running the scenarios")
+    parser.add_argument("--extruders", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-p99-us", type=float, help="Fail if the p99 per-report latency is above this")
+    parser.add_argument("--max-emergency-us", type=float, default=1000.0,
+                        help="Fail if the time from a runaway being caught to the emergency GCode being handed to "
+                             "the comm layer is above this")
+    parser.add_argument("--min-reports-per-sec", type=float, help="Fail if the throughput is below this")
+    parser.add_argument("--predictive", action="store_true", help="Run every scenario with predictive detection")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    args = parser.parse_args()
+
+    # The harness is only interested in the numbers, keep the plugin's own logging quiet
+    logging.getLogger('octoprint.plugins.ThermalRunaway').setLevel(logging.CRITICAL + 1)
+
+    if args.replay:
+        runs = [(Scenario('replay', args.replay, None), load_stream(args.replay))]
+    else:
+        selected = [s for s in SCENARIOS if not args.scenario or s.name in args.scenario]
+        runs = [(s, s.generate(args.extruders, args.seed)) for s in selected]
+
+    failed = False
+    results = []
+    for scenario, stream in runs:
+        overrides = dict(scenario.overrides or {})
+        if args.predictive:
+            overrides['predictiveDetection'] = True
+        # Recorded streams already have real timestamps
+        result = run_stream(stream, overrides, epoch=0.0 if scenario.generate is None else EPOCH)
+        if scenario.generate is None:
+            problems, timeToDetection = [], (result['detections'][0] if result['detections'] else None)
+        else:
+            problems, timeToDetection = check_scenario(scenario, result)
+        if args.max_p99_us is not None and result['p99us'] > args.max_p99_us:
+            problems.append('p99 latency {:.1f}us above {:.1f}us'.format(result['p99us'], args.max_p99_us))
+        if result['emergencyMaxus'] is not None and result['emergencyMaxus'] > args.max_emergency_us:
+            problems.append('emergency GCode sent {:.1f}us after detection, above {:.1f}us'.format(
+                result['emergencyMaxus'], args.max_emergency_us))
+        if args.min_reports_per_sec is not None and result['reportsPerSec'] < args.min_reports_per_sec:
+            problems.append('{:.0f} reports/sec below {:.0f}'.format(result['reportsPerSec'],
+                                                                      args.min_reports_per_sec))
+        failed = failed or bool(problems)
+        result.update(name=scenario.name, timeToDetection=timeToDetection, problems=problems)
+        del result['commands']
+        results.append(result)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print("{:<10} {:>8} {:>12} {:>9} {:>9} {:>9} {:>9} {:>10} {:>8} {:>6}  {}".format(
+            'scenario', 'reports', 'reports/s', 'p50 us', 'p90 us', 'p99 us', 'max us', 'detect s', 'stop us',
+            'ui msg', 'result'))
+        for result in results:
+            print("{:<10} {:>8} {:>12.0f} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f} {:>10} {:>8} {:>6}  {}".format(
+                result['name'], result['reports'], result['reportsPerSec'], result['p50us'], result['p90us'],
+                result['p99us'], result['maxus'],
+                '-' if result['timeToDetection'] is None else '{:.1f}'.format(result['timeToDetection']),
+                '-' if result['emergencyMaxus'] is None else '{:.1f}'.format(result['emergencyMaxus']),
+                result['messages'],
+                '; '.join(result['problems']) or 'ok'))
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
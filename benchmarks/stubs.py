@@ -0,0 +1,115 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+# Stand-ins for the objects OctoPrint injects into a plugin, so that ThermalRunawayPlugin can be run outside OctoPrint
+
+import copy
+import shutil
+import tempfile
+import time
+
+from octoprint_ThermalRunaway.plugin import ThermalRunawayPlugin
+from octoprint_ThermalRunaway.settings import build_snapshot
+
+
+class StubSettings(object):
+    # Minimal version of OctoPrint's PluginSettings. Like the real thing, get() walks the path through the
+    # user's config first and then through the plugin defaults, and every call is counted
+    def __init__(self, defaults, overrides=None):
+        self.defaults = copy.deepcopy(defaults)
+        self.config = copy.deepcopy(overrides or {})
+        self.calls = 0
+
+    def _walk(self, source, path):
+        node = source
+        for key in path:
+            if not isinstance(node, dict) or key not in node:
+                raise KeyError(key)
+            node = node[key]
+        return node
+
+    def get(self, path, **kwargs):
+        self.calls += 1
+        for source in (self.config, self.defaults):
+            try:
+                return copy.deepcopy(self._walk(source, path))
+            except KeyError:
+                continue
+        return None
+
+    def get_int(self, path, **kwargs):
+        return int(self.get(path))
+
+    def get_float(self, path, **kwargs):
+        return float(self.get(path))
+
+    def get_boolean(self, path, **kwargs):
+        return bool(self.get(path))
+
+    def global_get_float(self, path, **kwargs):
+        # OctoPrint's own settings, only the ones the plugin reads
+        return {('serial', 'timeout', 'temperatureAutoreport'): 2.0}.get(tuple(path))
+
+    def global_get_boolean(self, path, **kwargs):
+        return {('serial', 'capabilities', 'autoreport_temp'): True}.get(tuple(path))
+
+    def set(self, path, value, **kwargs):
+        node = self.config
+        for key in path[:-1]:
+            node = node.setdefault(key, {})
+        node[path[-1]] = value
+
+
+class StubPrinter(object):
+    # Records every command the plugin sends to the printer
+    def __init__(self):
+        self.sent = []
+
+    def commands(self, commands, *args, **kwargs):
+        self.sent.append(commands)
+
+
+class StubComm(object):
+    # Stands in for OctoPrint's MachineCom, records every command sent straight to it and when it was sent
+    def __init__(self):
+        self.sent = []
+
+    def sendCommand(self, cmd, cmd_type=None, part_of_job=False, processed=False, force=False, on_sent=None,
+                    tags=None):
+        self.sent.append((cmd, time.perf_counter()))
+
+
+class StubPluginManager(object):
+    # Returns whatever hooks have been registered with it, and records the messages sent to the UI
+    def __init__(self, hooks=None):
+        self.hooks = hooks or {}
+        self.messages = []
+
+    def get_hooks(self, hook):
+        return dict(self.hooks.get(hook, {}))
+
+    def send_plugin_message(self, plugin, data):
+        self.messages.append((plugin, data))
+
+
+# Create a plugin instance with the stand-ins injected, the same way OctoPrint would
+def make_plugin(overrides=None, hooks=None):
+    plugin = ThermalRunawayPlugin()
+    plugin._identifier = "ThermalRunaway"
+    plugin._plugin_version = "bench"
+    plugin._settings = StubSettings(plugin.get_settings_defaults(), overrides)
+    plugin._printer = StubPrinter()
+    plugin._plugin_manager = StubPluginManager(hooks)
+    plugin._data_folder = tempfile.mkdtemp(prefix="ThermalRunaway")
+    return plugin
+
+
+# Shut a plugin from make_plugin down the way OctoPrint would, and remove its data folder
+def close_plugin(plugin):
+    plugin.on_shutdown()
+    shutil.rmtree(plugin._data_folder, ignore_errors=True)
+
+
+# Build a settings snapshot from the plugin defaults, for running the engine without a plugin
+def make_snapshot(overrides=None):
+    return build_snapshot(StubSettings(ThermalRunawayPlugin().get_settings_defaults(), overrides))
@@ -0,0 +1,161 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+# How quickly a runaway can be caught is limited by how often the printer reports its temps. Firmware that can auto
+# report them (M155) is usually set to report every few seconds to save serial bandwidth. While a heater is in a
+# warning that isn't enough, so the reports are sped up with M155 S<fast> until every warning has cleared, and then
+# put back to the interval OctoPrint set up.
+
+# Name of the firmware capability that says M155 is supported, as reported in the M115 response
+CAPABILITY = "AUTOREPORT_TEMP"
+
+# Tags added to the M155 commands we send, so that other plugins can tell where they came from
+COMMAND_TAGS = {"source:plugin", "plugin:ThermalRunaway", "trigger:ThermalRunaway.autoreport"}
+
+
+# Interval to send with M155, which the firmware reads as whole seconds and takes 0 to mean stop reporting
+def report_interval(seconds):
+    return max(1, int(round(seconds)))
+
+
+class AutoReportController(object):
+    # Speeds up the temperature auto report while any heater is in a warning.
+    #   send is called with each M155 command to send
+    #   interval is the auto report interval OctoPrint uses, restored once the warnings have cleared
+    #   fast is the interval used while a heater is in a warning
+    # Nothing is sent until the firmware has said that it supports auto reporting, or at all if auto reporting is
+    # turned off in OctoPrint's serial settings (OctoPrint polls with M105 then). Changes are sent at most once every
+    # minChange seconds, and the interval is only restored once there has been no warning for restoreDelay seconds,
+    # so a heater going in and out of a warning doesn't flood the printer with M155. A heater whose set temp has just
+    # been changed goes into a low/high warning on that report (the temp hasn't moved yet), so those only speed the
+    # reports up once they are still there on a later report. If the reports don't speed up within verifyWindow
+    # seconds of asking, the firmware is taken not to support it and it isn't asked again.
+    # All times are report times, warning() and update() are only called from the evaluator
+    def __init__(self, send, logger, interval=2.0, fast=1.0, minChange=5.0, restoreDelay=10.0, verifyWindow=10.0):
+        self.send = send
+        self.logger = logger
+        self.interval = interval
+        self.fast = fast
+        self.minChange = minChange
+        self.restoreDelay = restoreDelay
+        self.verifyWindow = verifyWindow
+        self.enabled = True
+        self.allowed = True  # False if auto reporting is turned off in OctoPrint, treated as not supported
+
+        self.reset()
+
+        # Counters
+        self.sent = 0  # M155 commands sent
+
+    # Forget everything about the firmware, used when the printer is disconnected
+    def reset(self):
+        self.supported = None  # None until the firmware has reported its capabilities
+        self.wanted = False  # True while a heater is in a warning, or hasn't been out of one for restoreDelay
+        self.isFast = False  # True once M155 S<fast> has been sent, until the interval has been put back
+        self.active = False  # True while update() has anything to do
+        self.pending = False  # True while a heater has gone into a low/high warning on its latest report
+        self.lastChange = None  # Time the last M155 was sent
+        self.fastSince = None  # Time M155 S<fast> was sent, None once the reports are known to have sped up
+        self.lastReport = None
+        self.quietSince = None  # Time since when no heater has been in a warning
+
+    # Called with each firmware capability OctoPrint reads from the M115 response
+    def capability(self, name, enabled):
+        if name != CAPABILITY:
+            return
+        self.supported = bool(enabled)
+        if enabled and not self.allowed:
+            self.logger.info('Firmware supports auto reporting temps, but it is turned off in OctoPrint\'s serial '
+                             'settings, the report interval won\'t be changed')
+            return
+        self.logger.info('Firmware %s auto reporting temps, %s', 'supports' if enabled else 'doesn\'t support',
+                         'the reports will be sped up during warnings' if enabled and self.enabled else
+                         'the report interval won\'t be changed')
+
+    # Called from the engine when a heater goes into a warning, kind is low, high, rate, stall or model
+    def warning(self, heater, kind, receivedAt):
+        if not self.enabled or not self.allowed or not self.supported or self.fast >= self.interval:
+            return
+        if kind in ('low', 'high'):
+            # Wait for the next report, update() speeds the reports up if the heater is still in the warning
+            self.pending = True
+            self.active = True
+            return
+        self.wanted = True
+        self.quietSince = None
+        self.active = True
+        self.update_interval(receivedAt)
+
+    # Called after each report while active is True, with the heaters that have been checked
+    def update(self, heaters):
+        now = 0.0
+        inWarning = False
+        pending = False
+        for heater in heaters:
+            if heater.received > now:
+                now = heater.received
+            if heater.tripped:
+                continue
+            if heater.rateWarning or heater.modelWarning:
+                inWarning = True
+            for warningTime in (heater.warningLow, heater.warningHigh):
+                if warningTime and warningTime < heater.received:
+                    inWarning = True
+                elif warningTime:
+                    pending = True
+        self.pending = pending
+
+        # Check that the firmware has actually sped up the reports
+        if self.fastSince is not None:
+            if self.lastReport is not None and now - self.lastReport <= self.fast * 1.5:
+                self.fastSince = None
+            elif now - self.fastSince > self.verifyWindow:
+                self.logger.warning('The temperature reports didn\'t speed up after sending M155 S%s, not changing '
+                                    'the report interval again until the printer reconnects', self.fast)
+                self.supported = False
+                self.wanted = False
+        self.lastReport = now
+
+        if inWarning and self.supported and self.allowed and self.enabled:
+            self.wanted = True
+            self.quietSince = None
+        elif self.wanted:
+            if self.quietSince is None:
+                self.quietSince = now
+            if now - self.quietSince >= self.restoreDelay:
+                self.wanted = False
+        self.update_interval(now)
+        if self.pending:
+            self.active = True
+
+    # Send M155 if the interval doesn't match what is wanted, and it hasn't been changed too recently
+    def update_interval(self, now):
+        if self.wanted == self.isFast:
+            self.active = self.wanted
+            return
+        self.active = True
+        if self.lastChange is not None and now - self.lastChange < self.minChange:
+            return
+        self.lastChange = now
+        self.isFast = self.wanted
+        if self.isFast:
+            self.fastSince = now
+            self.lastReport = None
+            command = "M155 S{:d}".format(report_interval(self.fast))
+            self.logger.info('Heater in warning, speeding up the temperature reports (%s)', command)
+        else:
+            self.fastSince = None
+            command = "M155 S{:d}".format(report_interval(self.interval))
+            self.logger.info('No heater in warning, putting the temperature reports back (%s)', command)
+        self.sent += 1
+        try:
+            self.send(command)
+        except Exception as e:
+            self.logger.exception("Exception while sending {}: {}".format(command, e))
+
+    def stats(self):
+        return dict(
+            supported=self.supported,
+            fast=self.isFast,
+            sent=self.sent
+        )
@@ -0,0 +1,203 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+# Companion watchdog, run as its own process next to OctoPrint. It reads the state the plugin publishes to shared
+# memory (see sharedstate.py) and:
+#     - runs the heaters through the same checks the plugin does, with its own MonitorEngine
+#     - catches a heater that is turned on going without a report, the same way the plugin's watchdog does
+#     - catches the plugin's heartbeat stopping while a heater is turned on, which means OctoPrint's Python process
+#       has hung, is stuck in a long pause or has died
+# Neither of the last two is checked while the printer is disconnected from OctoPrint, the plugin marks the state as
+# not armed then and the reports stopping is expected.
+# and then takes its own emergency action, which doesn't go through OctoPrint at all: run a command (eg. one that
+# switches a smart plug or relay off), send a JSON message to a local socket, and/or call a Python function (eg. one
+# that sets a GPIO pin).
+#
+# Run with:
+#     thermalrunaway-companion [--state PATH] [--stall 10] [--command CMD] [--socket PATH]
+#                              [--callback module:function] [--set tMaxDiff=15 ...]
+# or, without installing the plugin:
+#     python -m octoprint_ThermalRunaway.companion ...
+#
+# The shared state has to be turned on in the plugin settings. The settings given with --set should match the plugin's
+
+import argparse
+import importlib
+import json
+import logging
+import os
+import shlex
+import socket
+import subprocess
+import time
+
+from .engine import MonitorEngine
+from .replay import parse_overrides
+from .settings import build_snapshot_from_dict
+from .sharedstate import StateReader, default_path
+from .watchdog import StaleWatchdog
+
+
+class CompanionAction(object):
+    # The companion's own emergency action. Each event is a dict with at least event (runaway, stale or stalled),
+    # heater, set and current, and is passed to every path that has been set up
+    def __init__(self, logger, command=None, socketPath=None, callback=None):
+        self.logger = logger
+        self.command = shlex.split(command) if command else None  # Run with the event in THERMALRUNAWAY_* variables
+        self.socketPath = socketPath  # Unix socket the event is sent to as a line of JSON
+        self.callback = callback  # Called with the event
+
+        self.fired = 0
+
+    def fire(self, event):
+        self.fired += 1
+        self.logger.critical('Companion watchdog caught %s on heater %s (set %s, current %s), taking emergency action',
+                             event['event'], event['heater'], event['set'], event['current'])
+        if self.command:
+            try:
+                environment = dict(os.environ)
+                environment.update(('THERMALRUNAWAY_' + key.upper(), str(value)) for key, value in event.items())
+                subprocess.Popen(self.command, env=environment)
+            except Exception as e:
+                self.logger.exception("Exception while running {}: {}".format(self.command, e))
+        if self.socketPath:
+            try:
+                connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                try:
+                    connection.settimeout(1.0)
+                    connection.connect(self.socketPath)
+                    connection.sendall(json.dumps(event).encode() + b'\n')
+                finally:
+                    connection.close()
+            except Exception as e:
+                self.logger.exception("Exception while sending to {}: {}".format(self.socketPath, e))
+        if self.callback is not None:
+            try:
+                self.callback(event)
+            except Exception as e:
+                self.logger.exception("Exception in the emergency callback: {}".format(e))
+
+
+# Import a callback given as module:function
+def load_callback(spec):
+    module, separator, name = spec.partition(':')
+    if not separator:
+        raise ValueError('{} should be module:function'.format(spec))
+    return getattr(importlib.import_module(module), name)
+
+
+class CompanionWatchdog(object):
+    # Polls the shared state and feeds new reports to its own engine. stall is how many seconds the publisher's
+    # heartbeat may stop for while a heater is turned on
+    def __init__(self, reader, settings, action, logger, stall=10.0, clock=time.time):
+        self.reader = reader
+        self.action = action
+        self.logger = logger
+        self.stall = stall
+        self.clock = clock
+
+        self.engine = MonitorEngine(settings, logger, on_runaway=self._runaway)
+        self.staleWatchdog = StaleWatchdog(self.engine, logger, self._stale, clock=clock)
+        self.staleWatchdog.timeout = settings.staleTimeout
+        self.staleEnabled = settings.staleDetection
+        self.staleAction = settings.staleAction
+
+        self.lastSeen = {}  # heater -> time of the last report fed to the engine
+        self.stalled = False  # True once the heartbeat stall has been acted on, until it starts again
+        self.lastState = None
+
+    def _runaway(self, heater, setTemp, currentTemp, runawayType):
+        self.action.fire(dict(event='runaway', heater=heater, set=setTemp, current=currentTemp, type=runawayType))
+
+    def _stale(self, heater, age):
+        # As in the plugin, the reports stopping is only acted on if staleAction is heatersOff or emergency
+        if self.staleAction == 'warn':
+            self.logger.warning('No temperature report for heater %s in %.0f seconds while it is set to %s',
+                                heater.name, age, heater.set)
+            return
+        self.action.fire(dict(event='stale', heater=heater.name, set=heater.set, current=heater.current,
+                              age=round(age, 1)))
+
+    # Read the shared state once and check it. Returns the state read, or None if there wasn't one
+    def poll(self):
+        now = self.clock()
+        state = self.reader.read()
+        if state is None:
+            # The plugin isn't running, or has shut down cleanly and removed the file
+            self.lastState = None
+            return None
+
+        temps = {}
+        lastSeen = self.lastSeen
+        for heater in state.heaters:
+            if heater.received > lastSeen.get(heater.name, 0.0):
+                lastSeen[heater.name] = heater.received
+                temps[heater.name] = (heater.current, heater.set, heater.received)
+        if temps:
+            self.engine.evaluate(temps)
+        if not state.armed:
+            # The printer has been disconnected, the heaters are watched again from their next report
+            self.staleWatchdog.disarm()
+        elif self.staleEnabled:
+            self.staleWatchdog.check(now)
+
+        # The heartbeat is written every second by a thread in OctoPrint's process, it only stops if that process does
+        heatersOn = [heater for heater in state.heaters if heater.set > 0.0]
+        if state.armed and now - state.heartbeat > self.stall:
+            if not self.stalled and heatersOn:
+                self.stalled = True
+                heater = heatersOn[0]
+                self.action.fire(dict(event='stalled', heater=heater.name, set=heater.set, current=heater.current,
+                                      age=round(now - state.heartbeat, 1), pid=state.pid))
+        else:
+            self.stalled = False
+        self.lastState = state
+        return state
+
+    def run(self, interval=0.5):
+        while True:
+            try:
+                self.poll()
+            except Exception as e:
+                self.logger.exception("Exception in the companion watchdog: {}".format(e))
+            time.sleep(interval)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Watch the heaters from outside OctoPrint, using the state the "
+                                                 "Thermal Runaway plugin publishes to shared memory")
+    parser.add_argument("--state", default=default_path(), help="path of the shared state (default %(default)s)")
+    parser.add_argument("--stall", type=float, default=10.0,
+                        help="seconds the plugin's heartbeat may stop for while a heater is on (default %(default)s)")
+    parser.add_argument("--interval", type=float, default=0.5, help="seconds between reads (default %(default)s)")
+    parser.add_argument("--command", help="command to run on an emergency, the details are passed in "
+                                          "THERMALRUNAWAY_* environment variables")
+    parser.add_argument("--socket", help="unix socket to send each emergency to, as a line of JSON")
+    parser.add_argument("--callback", metavar="MODULE:FUNCTION", help="Python function to call with each emergency")
+    parser.add_argument("--set", action="append", metavar="SETTING=VALUE", dest="overrides",
+                        help="override a plugin setting, eg. --set tMaxDiff=15. Can be given more than once")
+    parser.add_argument("--verbose", action="store_true", help="show the engine's warning log messages")
+    args = parser.parse_args(argv)
+
+    try:
+        overrides = parse_overrides(args.overrides)
+        callback = load_callback(args.callback) if args.callback else None
+    except (ValueError, ImportError, AttributeError) as e:
+        parser.error(str(e))
+
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s')
+    logger = logging.getLogger('octoprint.plugins.ThermalRunaway.companion')
+    logger.setLevel(logging.INFO if args.verbose else logging.ERROR)
+
+    action = CompanionAction(logger, args.command, args.socket, callback)
+    watchdog = CompanionWatchdog(StateReader(args.state), build_snapshot_from_dict(overrides), action, logger,
+                                 stall=args.stall)
+    try:
+        watchdog.run(args.interval)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,96 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+# Import time. Used to measure how long it takes to get the emergency GCode out
+import time
+
+from .stats import LatencyHistogram
+
+# Tags added to every command we send, so that other plugins can tell where they came from
+COMMAND_TAGS = {"source:plugin", "plugin:ThermalRunaway", "trigger:ThermalRunaway.emergency"}
+
+
+# Split the emergency GCode setting into single commands, it may hold more than one separated by new lines
+def split_commands(gcode):
+    return [line.strip() for line in (gcode or "").splitlines() if line.strip()]
+
+
+# Commands that turn off each of the heaters given, eg. M104 T0 S0 for T0
+def heater_off_commands(heaters):
+    commands = []
+    for heater in heaters:
+        if heater == 'B':
+            commands.append("M140 S0")
+        elif heater == 'C':
+            commands.append("M141 S0")
+        elif heater[:1] == 'T' and heater[1:].isdigit():
+            commands.append("M104 T{} S0".format(heater[1:]))
+    return commands
+
+
+class EmergencyAction(object):
+    # Gets the emergency GCode to the printer as fast as possible once a runaway has been caught.
+    # Commands go straight to OctoPrint's comm layer (the comm object is passed to us with every temperature report)
+    # rather than through the printer's command queue, so they don't wait behind a print's queued lines. OctoPrint's
+    # comm layer writes emergency commands such as M112 to the serial port right away, skipping its own send queue.
+    # If we haven't been given the comm object yet, the printer interface is used with force=True instead
+    def __init__(self, printer, logger):
+        self.printer = printer
+        self.logger = logger
+        self.comm = None
+
+        # Time from the runaway being caught to the emergency GCode being handed over to be sent
+        self.latency = LatencyHistogram()
+        self.lastLatency = None
+        self.fired = 0  # Number of times the emergency GCode has been sent
+        self.failed = 0  # Number of commands that raised an exception when sent
+
+    # Send a single command by the fastest route we have
+    def send(self, command):
+        comm = self.comm
+        if comm is not None:
+            try:
+                comm.sendCommand(command, force=True, tags=COMMAND_TAGS)
+            except TypeError:
+                # Older versions of OctoPrint don't take tags
+                comm.sendCommand(command, force=True)
+        else:
+            self.printer.commands(command, force=True, tags=COMMAND_TAGS)
+
+    # Send the emergency GCode, then the commands to turn off the heaters given. detected is the time.perf_counter()
+    # time the runaway was caught. Returns the number of seconds between detection and the emergency GCode being
+    # handed over
+    def fire(self, detected, emergencyGcode, heaters=()):
+        for command in split_commands(emergencyGcode):
+            self._send_logged(command)
+        latency = time.perf_counter() - detected
+        self.latency.observe(latency)
+        self.lastLatency = latency
+        self.fired += 1
+
+        self.heaters_off(heaters)
+
+        self.logger.warning('Emergency GCode sent %.3f ms after the Thermal Runaway was caught (%s)',
+                            latency * 1000, 'through the comm layer' if self.comm is not None else 'forced')
+        return latency
+
+    # Turn off each of the heaters given, without sending the emergency GCode
+    def heaters_off(self, heaters):
+        for command in heater_off_commands(heaters):
+            self._send_logged(command)
+
+    # Send a command, logging rather than raising if it fails so that the rest still get sent
+    def _send_logged(self, command):
+        try:
+            self.send(command)
+        except Exception as e:
+            self.failed += 1
+            self.logger.exception("Exception while sending {}: {}".format(command, e))
+
+    def stats(self):
+        return dict(
+            fired=self.fired,
+            failed=self.failed,
+            lastLatency=self.lastLatency,
+            latency=self.latency.snapshot()
+        )
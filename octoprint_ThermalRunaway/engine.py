@@ -0,0 +1,491 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+# The thermal runaway checks, kept separate from the OctoPrint plugin so that they can be fed from anything that
+# produces temperature reports: the OctoPrint hook, a parsed M105 response, a recorded log or a test feed.
+# A MonitorEngine watches the heaters of a single printer, a FarmMonitor runs one MonitorEngine per printer.
+
+# Import collections. Used to keep a bounded list of past runaways
+import collections
+# Import logging to allow for easier debugging
+import logging
+# Import time. Used to timestamp reports that come in without one
+import time
+
+from .heater import HeaterState
+from .model import MODEL_WARMUP
+from .settings import heater_class
+
+# Seconds between reminders that a heater is latched after a runaway and isn't being checked
+LATCHED_LOG_INTERVAL = 60.0
+
+
+# NaN isn't valid JSON, so report values that aren't known yet as None
+def _number(value):
+    return None if value != value else value
+
+
+class MonitorEngine(object):
+    # Checks the temperature reports of one printer for thermal runaways.
+    # settings is a SettingsSnapshot; assign a new one to settings to change them, the engine picks it up on the next
+    # report. on_runaway is called with (heater id, set temp, current temp, over/under) once per runaway, on_warning is
+    # called with (heater id, low/high/rate/stall/model, time) each time a heater starts to look like it might be in runaway
+    def __init__(self, settings, logger, on_runaway=None, on_warning=None):
+        self.logger = logger
+        self.settings = settings
+        self.appliedSettings = settings
+        self.on_runaway = on_runaway
+        self.on_warning = on_warning
+        # Called with the HeaterState after every report for a heater has been checked, eg. to store its history
+        self.recorder = None
+
+        self.runaway_message = "Thermal Runaway ({t} temp) caught on heater {h}. Reported temp is {c}, set temp is {s} "
+
+        # Heaters are added the first time they show up in a temperature report.
+        # heaters is in the order they were first seen, heaterIndex maps the id of the heater to its state, or to
+        # None for anything reported that we can't monitor
+        self.heaters = []
+        self.heaterIndex = {}
+
+        # Most recent runaways, oldest first
+        self.incidents = collections.deque(maxlen=50)
+        self.incidentCount = 0
+
+    # update the target range that heaters are expected to be in
+    def update_target_temp_range(self, heater, newSetTemp):
+        if not heater.update_target_temp_range(newSetTemp):
+            # hasn't changed, no need to update
+            return
+
+        # Log what we set the max and min temps to
+        if heater.set > 0.0:
+            self.logger.debug("Heater %s is set to %s. Max temp set to %s, Min temp set to %s",
+                              heater.name, heater.set, heater.max, heater.min)
+        else:
+            self.logger.debug("Heater %s is set to less than 0.0. Max temp set to %s, Min temp set to %s",
+                              heater.name, heater.max, heater.min)
+
+    # reset warning, while logging it
+    def reset_warning(self, heater, direction):
+        warningTime = heater.get_warning(direction)
+        if warningTime != 0:
+            # info-log that we've gotten out of warning state
+            self.logger.info('%s temperature is no longer too %s after %s seconds, (%s=%s, current=%s, set=%s)',
+                             heater.name, direction, heater.received - warningTime,
+                             direction, heater.low if direction == 'low' else heater.high, heater.current, heater.set)
+            heater.set_warning(direction, 0)
+            heater.get_log_throttle(direction).reset()
+
+    # unify high/low checks
+    # direction = high/low, tracked = the low/high temp we are comparing against
+    def check_threshold_direction(self, heater, direction, tracked):
+        currentTime = heater.received
+
+        # check if we're currently within the threshold
+        # (moving back up if we're too low, moving back down if we're too high)
+        if (heater.current > tracked) if direction == 'low' else (heater.current < tracked):
+            # we're within threshold, nothing to worry about
+            # reset any warnings
+            self.reset_warning(heater, direction)
+            self.logger.debug('Heater %s is not %s, continuing', heater.name, direction)
+            return
+
+        # we're not within threshold, start processing warnings
+        warningTime = heater.get_warning(direction)
+
+        # check if we're already in warning
+        if warningTime == 0:
+            # we were not, let's set it now
+            heater.set_warning(direction, currentTime)
+            heater.get_log_throttle(direction).reset(currentTime)
+            self.logger.warning('%s temperature is now too %s, (%s=%s, current=%s, set=%s)',
+                                heater.name, direction, direction, tracked, heater.current, heater.set)
+            if self.on_warning is not None:
+                self.on_warning(heater.name, direction, currentTime)
+        else:
+            # we were, let's log that we're still in it, but only once every warningLogInterval seconds
+            suppressed = heater.get_log_throttle(direction).ready(currentTime, self.appliedSettings.warningLogInterval)
+            if suppressed >= 0:
+                self.logger.warning('%s temperature has been too %s for %s seconds, (%s=%s, current=%s, set=%s), '
+                                    '%s similar messages suppressed',
+                                    heater.name, direction, currentTime - warningTime,
+                                    direction, tracked, heater.current, heater.set, suppressed)
+
+            # check if we've been on the wrong side of the threshold for longer than the specified delay
+            # if so, we're in runaway
+            if currentTime > warningTime + int(heater.delay):
+                self.trip_heater(heater, 'under' if direction == 'low' else 'over')
+
+    # Latch a heater into runaway and call on_runaway. Only ever runs once per runaway,
+    # the heater isn't checked again until clear_trip is called
+    # reason is what caught it: delay (outside min/max for too long), rate (rising too fast), stall (not heating) or
+    # model (about to leave min/max when the heater's model says it shouldn't)
+    def trip_heater(self, heater, runawayType, reason='delay'):
+        heater.tripped = heater.received
+        heater.logTripped.reset(heater.received)
+        heater.incident = {
+            'heater': heater.name,
+            'type': runawayType,
+            'reason': reason,
+            'set': heater.set,
+            'current': heater.current,
+            'warningSince': heater.get_warning('low' if runawayType == 'under' else 'high') if reason == 'delay' else
+                            heater.modelWarning if reason == 'model' else heater.rateWarning,
+            'tripped': heater.tripped,
+            'cleared': None,
+            'clearedBy': None
+        }
+        self.incidents.append(heater.incident)
+        self.incidentCount += 1
+
+        # Call on_runaway and pass the required details
+        if self.on_runaway is not None:
+            self.on_runaway(heater.name, heater.set, heater.current, runawayType)
+        # Log that we caught a thermal runaway
+        self.logger.critical(self.runaway_message.format(h=heater.name,
+                                                            c=heater.current,
+                                                            s=heater.set,
+                                                            t=runawayType))
+
+    # Release a heater from runaway so that it is checked again, reason is logged and stored with the incident
+    def clear_trip(self, heater, reason):
+        if heater.incident is not None:
+            heater.incident['cleared'] = heater.received
+            heater.incident['clearedBy'] = reason
+        self.logger.warning('Thermal Runaway on heater %s cleared (%s) after %s seconds',
+                            heater.name, reason, heater.received - heater.tripped)
+        heater.tripped = 0
+        heater.incident = None
+        heater.resetRequested = False
+        # Start the checks again from scratch
+        heater.warningLow = 0
+        heater.warningHigh = 0
+        heater.rateWarning = 0
+        heater.modelWarning = 0
+        heater.low = heater.current
+        heater.high = heater.current
+
+    # Ask the evaluator to clear the runaway on a heater, or on all heaters if none is given.
+    # Returns the ids of the heaters that will be reset
+    def reset_runaway(self, name=None):
+        heaters = []
+        for heater in list(self.heaters):
+            if heater.tripped and (name is None or heater.name == name):
+                heater.resetRequested = True
+                heaters.append(heater.name)
+        self.logger.info('Reset requested for %s', ', '.join(heaters) or 'no heaters')
+        return heaters
+
+    def check_heater_thresholds(self, heater):
+        current = heater.current
+
+        if heater.min <= current <= heater.max:
+            # temperature is within target range, skip
+            self.logger.debug('%s temperature is within target range, skipping', heater.name)
+            # reset any warnings first
+            if heater.warningLow != 0:
+                self.reset_warning(heater, 'low')
+            if heater.warningHigh != 0:
+                self.reset_warning(heater, 'high')
+            # might as well also reset tracked low/high temps since we're in a good range
+            heater.low = current
+            heater.high = current
+            return
+
+        if not current >= heater.min:
+            # temp below target range
+            self.check_threshold_direction(heater, 'low', heater.low)
+
+        if not current <= heater.max:
+            # temp above target range
+            self.check_threshold_direction(heater, 'high', heater.high)
+
+    # Check how fast the heater is heating up. Catches a heater that is still climbing well past its set temp, or one
+    # that isn't heating at all while it's well below its set temp, without waiting for the delay to run out
+    def check_rate_of_change(self, heater, confirm):
+        history = heater.history
+        # Only once the heater is turned on and the set temp has been the same for a whole window
+        if not heater.set > 0.0 or heater.received - heater.setChanged < history.window:
+            heater.rateWarning = 0
+            return
+
+        slope = history.slope()
+        runawayType = None
+        if heater.maxRiseRate > 0 and heater.current > heater.set + heater.maxDiff / 2 and slope > heater.maxRiseRate:
+            runawayType, reason = 'over', 'rate'
+        elif heater.minHeatRate > 0 and heater.current < heater.min and slope < heater.minHeatRate:
+            runawayType, reason = 'under', 'stall'
+
+        if runawayType is None:
+            if heater.rateWarning != 0:
+                self.logger.info('%s rate of change is back to normal (%.3f C/s)', heater.name, slope)
+            heater.rateWarning = 0
+            return
+
+        if heater.rateWarning == 0:
+            heater.rateWarning = heater.received
+            self.logger.warning('%s temperature is changing at %.3f C/s, (current=%s, set=%s, %s)',
+                                heater.name, slope, heater.current, heater.set,
+                                'rising too fast' if reason == 'rate' else 'not heating up')
+            if self.on_warning is not None:
+                self.on_warning(heater.name, reason, heater.received)
+        if heater.received - heater.rateWarning >= confirm:
+            self.trip_heater(heater, runawayType, reason)
+
+    # Compare where the heater is heading with where its model says it should be heading. Catches a heater that is
+    # about to leave min/max when it has no reason to, eg. a heater cartridge or thermistor that has come loose, before
+    # it gets there. Then teach the model the new report, unless the heater is already looking suspicious
+    def check_prediction(self, heater, settings):
+        model = heater.model
+        history = heater.history
+        current = heater.current
+        setTemp = heater.set
+        runawayType = None
+        if model.samples >= MODEL_WARMUP and setTemp == setTemp:
+            horizon = settings.predictionHorizon
+            slope = history.slope()
+            heading = current + slope * horizon
+            expected = model.predict(current, setTemp, horizon)
+            margin = heater.maxDiff / 2
+            if slope < 0 and heading < heater.min and expected - heading > margin:
+                runawayType = 'under'
+            elif slope > 0 and heading > heater.max and heading - expected > margin:
+                runawayType = 'over'
+
+        if runawayType is None:
+            if heater.modelWarning != 0:
+                self.logger.info('%s is back to behaving the way its model expects', heater.name)
+            heater.modelWarning = 0
+        else:
+            if heater.modelWarning == 0:
+                heater.modelWarning = heater.received
+                self.logger.warning('%s temperature is heading for %.1f in %s seconds, its model expects %.1f, '
+                                    '(current=%s, set=%s)', heater.name, heading, horizon, expected, current, setTemp)
+                if self.on_warning is not None:
+                    self.on_warning(heater.name, 'model', heater.received)
+            if heater.received - heater.modelWarning >= settings.rateConfirm:
+                self.trip_heater(heater, runawayType, 'model')
+
+        # Changes right after the set temp changes are always learnt, after that anything the model is far off on is
+        # left out until it has settled, so that a fault isn't learnt as normal
+        model.update(heater.received, current, setTemp, learn=heater.modelWarning == 0,
+                     screen=heater.received - heater.setChanged >= history.window)
+
+    # Create the state for a heater we haven't seen before, returns None if it isn't something we can monitor
+    def add_heater(self, name, values):
+        heaterClass = heater_class(name)
+        if heaterClass is None:
+            # Not a heater, remember that so we don't check again
+            self.logger.info('Not monitoring %s, it is not a heater', name)
+            self.heaterIndex[name] = None
+            return None
+        if heaterClass == 'chamber' and not self.appliedSettings.chamberMonitoring:
+            # Most chambers are only a sensor, or warm up from the bed with nothing to turn off, so only checked once
+            # turned on in the settings
+            self.logger.info('Not monitoring chamber %s, chamber monitoring is turned off', name)
+            self.heaterIndex[name] = None
+            return None
+        if values[1] is None:
+            # A heater, but the report didn't include a set temp for it. Start monitoring it on the first one that does
+            return None
+
+        heater = HeaterState(name, heaterClass, getattr(self.appliedSettings, heaterClass))
+        self.heaters.append(heater)
+        self.heaterIndex[name] = heater
+        self.logger.info('Monitoring %s heater %s', heaterClass, name)
+        return heater
+
+    # Start or stop monitoring the chamber after the setting has changed. A chamber that was being checked is dropped,
+    # one that was being skipped is looked at again on its next report
+    def set_chamber_monitoring(self, enabled):
+        for name in [name for name in self.heaterIndex if heater_class(name) == 'chamber']:
+            del self.heaterIndex[name]
+        if not enabled:
+            self.heaters = [heater for heater in self.heaters if heater.heaterClass != 'chamber']
+        self.logger.info('Chamber monitoring turned %s', 'on' if enabled else 'off')
+
+    # update thresholds to current temp (only if they're moving in the right direction)
+    def update_stored_temps(self, heater):
+        current = heater.current
+        # only update low if we're higher than previous low
+        if current > heater.low:
+            heater.low = current
+        # only update high if we're lower than previous high
+        if current < heater.high:
+            heater.high = current
+
+    # Function to process temperatures received from the printer and check for a thermal runaway
+    # temps is keyed by heater, each value is (current, set, time received)
+    def evaluate(self, temps):
+        # Log that we have reached the start of evaluate
+        self.logger.debug('Reached start of evaluate')
+
+        # Grab the current settings snapshot once, so that the whole report is evaluated against the same settings
+        settings = self.settings
+
+        # If the settings have been changed since the last report, update the thresholds of every heater
+        if settings is not self.appliedSettings:
+            if settings.chamberMonitoring != self.appliedSettings.chamberMonitoring:
+                self.set_chamber_monitoring(settings.chamberMonitoring)
+            for heater in self.heaters:
+                heater.apply_settings(getattr(settings, heater.heaterClass))
+            self.appliedSettings = settings
+
+        heaterIndex = self.heaterIndex
+        recorder = self.recorder
+
+        # Loop through the heaters in the report
+        for name, values in temps.items():
+            try:
+                heater = heaterIndex[name]
+            except KeyError:
+                # First time we've seen this one
+                heater = self.add_heater(name, values)
+            if heater is None or values[1] is None:
+                # Not a heater, or the report didn't include a set temp for it
+                continue
+
+            # Store received temperatures for this heater
+            heater.current = float(values[0])
+            heater.update_received(values[2])
+            self.update_target_temp_range(heater, float(values[1]))
+            heater.history.add(heater.received, heater.current, heater.set)
+
+            # Once a heater has tripped we don't check it again until it's reset or the cool-down is over
+            if heater.tripped:
+                if heater.resetRequested:
+                    self.clear_trip(heater, 'reset')
+                elif settings.tripCooldown > 0 and heater.received - heater.tripped >= settings.tripCooldown:
+                    self.clear_trip(heater, 'cool-down')
+                else:
+                    # Nothing is checked on this heater until it is reset, so keep saying so
+                    suppressed = heater.logTripped.ready(heater.received, LATCHED_LOG_INTERVAL)
+                    if suppressed >= 0:
+                        self.logger.warning('Heater %s is still latched after the Thermal Runaway caught %.0f seconds '
+                                            'ago and is not being checked (current=%s, set=%s). Reset it from the '
+                                            'Thermal Runaway panel or the API once it is safe',
+                                            heater.name, heater.received - heater.tripped, heater.current, heater.set)
+                    if recorder is not None:
+                        recorder(heater)
+                    continue
+
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug('Checking heater %s (set = %s, high = %s, low = %s, current = %s)',
+                                  heater.name, heater.set, heater.high, heater.low, heater.current)
+
+            self.check_heater_thresholds(heater)
+
+            # Check the rate of change, unless the heater has just tripped
+            if settings.rateDetection and not heater.tripped:
+                self.check_rate_of_change(heater, settings.rateConfirm)
+
+            # Check where the heater is heading against its model, unless it has just tripped
+            if settings.predictiveDetection and not heater.tripped:
+                self.check_prediction(heater, settings)
+
+            # Update high/low temps at end of loop
+            self.update_stored_temps(heater)
+
+            if recorder is not None:
+                recorder(heater)
+
+        # log that we have reached the end of this function
+        self.logger.debug('Reached end of evaluate')
+        return
+
+    # Everything we know about each heater, as a list of dicts
+    def heater_status(self, now=None):
+        if now is None:
+            now = time.time()
+        horizon = self.appliedSettings.predictionHorizon
+        heaters = []
+        for heater in list(self.heaters):
+            heaters.append(dict(
+                name=heater.name,
+                **{'class': heater.heaterClass},
+                current=_number(heater.current),
+                set=_number(heater.set),
+                min=_number(heater.min),
+                max=_number(heater.max),
+                low=_number(heater.low),
+                high=_number(heater.high),
+                rateOfChange=_number(heater.history.slope()),
+                predicted=_number(heater.model.predict(heater.current, heater.set, horizon))
+                if heater.model.samples >= MODEL_WARMUP else None,
+                warningAge=dict(low=now - heater.warningLow if heater.warningLow else None,
+                                high=now - heater.warningHigh if heater.warningHigh else None),
+                tripped=bool(heater.tripped),
+                lastReportAge=now - heater.received if heater.reports else None,
+                maxGap=heater.maxGap,
+                reports=heater.reports
+            ))
+        return heaters
+
+
+class FarmMonitor(object):
+    # Runs a MonitorEngine for each printer in a farm from a single process. Reports can be fed in directly with
+    # feed(), or consumed from any number of asyncio sources at once with run().
+    # on_runaway is called with (printer id, heater id, set temp, current temp, over/under) once per runaway
+    def __init__(self, settings, logger=None, on_runaway=None):
+        self.settings = settings
+        self.logger = logger if logger is not None else logging.getLogger('thermalrunaway.farm')
+        self.on_runaway = on_runaway
+        self.engines = {}  # printer id -> MonitorEngine
+
+    # Get the engine for a printer, creating it the first time the printer is seen
+    def engine(self, printer):
+        engine = self.engines.get(printer)
+        if engine is None:
+            engine = MonitorEngine(self.settings, self.logger.getChild(str(printer)),
+                                   lambda *args: self._runaway(printer, *args))
+            self.engines[printer] = engine
+        return engine
+
+    def _runaway(self, printer, heater, setTemp, currentTemp, runawayType):
+        if self.on_runaway is not None:
+            self.on_runaway(printer, heater, setTemp, currentTemp, runawayType)
+
+    # Change the settings of every printer
+    def update_settings(self, settings):
+        self.settings = settings
+        for engine in self.engines.values():
+            engine.settings = settings
+
+    # Evaluate a report for one printer. temps is keyed by heater with (current, set) values, as OctoPrint or
+    # parse_temperature_line give them
+    def feed(self, printer, temps, receivedAt=None):
+        if receivedAt is None:
+            receivedAt = time.time()
+        report = {}
+        for heater, values in temps.items():
+            report[heater] = (values[0], values[1], receivedAt)
+        self.engine(printer).evaluate(report)
+
+    # Evaluate every report from an async source for one printer. The source yields (time received, temps) pairs,
+    # or raw items to pass through parse (eg. M105 response lines) if parse is given. Reports that parse to nothing
+    # are skipped
+    async def consume(self, printer, source, parse=None):
+        count = 0
+        async for item in source:
+            if parse is not None:
+                receivedAt, temps = time.time(), parse(item)
+            else:
+                receivedAt, temps = item
+            if not temps:
+                continue
+            try:
+                self.feed(printer, temps, receivedAt)
+            except Exception as e:
+                # Log that something went wrong, and carry on with the next report
+                self.logger.exception("Exception while evaluating temps for {}: {}".format(printer, e))
+            count += 1
+        return count
+
+    # Consume several sources at once, sources maps printer id -> source. Returns the number of reports evaluated for
+    # each printer once every source has run out
+    async def run(self, sources, parse=None):
+        # Import asyncio. Only here so that the plugin doesn't pay for importing it when it loads
+        import asyncio
+        printers = list(sources.keys())
+        counts = await asyncio.gather(*[self.consume(printer, sources[printer], parse) for printer in printers])
+        return dict(zip(printers, counts))
@@ -0,0 +1,122 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+from .logutil import LogThrottle
+from .history import HeaterHistory
+from .model import ThermalModel
+
+
+class HeaterState(object):
+    # Everything we track about a single heater. Slotted so that the per-report checks are plain attribute lookups
+    __slots__ = ('name', 'heaterClass', 'delay', 'maxDiff', 'maxOffTemp', 'maxRiseRate', 'minHeatRate',
+                 'current', 'set', 'high', 'low', 'min', 'max',
+                 'warningLow', 'warningHigh', 'logLow', 'logHigh', 'received',
+                 'tripped', 'incident', 'resetRequested', 'logTripped', 'history', 'setChanged', 'rateWarning',
+                 'model', 'modelWarning',
+                 'reports', 'maxGap')
+
+    def __init__(self, name, heaterClass, heaterSettings):
+        self.name = name  # id of the heater as reported by OctoPrint, eg. B or T0
+        self.heaterClass = heaterClass  # bed, tool or chamber, used to pick the thresholds from the settings
+
+        self.current = float('NaN')  # Last reported temp
+        self.set = float('NaN')  # Last reported set temp
+        self.high = float('NaN')  # Tracked temp for the too high check, only ever moves down
+        self.low = float('NaN')  # Tracked temp for the too low check, only ever moves up
+        self.min = float('NaN')  # Lowest temp allowed for the current set temp
+        self.max = float('NaN')  # Highest temp allowed for the current set temp
+
+        # Time that the heater went too low/high, 0 if it isn't
+        self.warningLow = 0
+        self.warningHigh = 0
+        # Used to limit how often we log that the heater is still too low/high
+        self.logLow = LogThrottle()
+        self.logHigh = LogThrottle()
+
+        self.received = 0  # Time that the last report for this heater was received
+        self.setChanged = 0  # Time that the set temp last changed
+        self.reports = 0  # Number of reports evaluated for this heater
+        self.maxGap = 0.0  # Longest time between two reports for this heater
+
+        # Recent samples and the rate of change worked out from them
+        self.history = HeaterHistory(window=heaterSettings.rateWindow)
+        # Time that the rate of change first looked like a runaway, 0 if it doesn't
+        self.rateWarning = 0
+
+        # Model of how the heater normally behaves, only updated when predictive detection is turned on
+        self.model = ThermalModel()
+        # Time that the heater first looked like it was about to leave min/max when the model says it shouldn't,
+        # 0 if it doesn't
+        self.modelWarning = 0
+
+        # Latched runaway state. tripped is the time the runaway was caught, 0 if it hasn't been
+        self.tripped = 0
+        self.incident = None  # Record of the current runaway, see MonitorEngine.trip_heater
+        self.resetRequested = False  # Set from outside the evaluator to ask for the latch to be cleared
+        self.logTripped = LogThrottle()  # Used to keep reminding that the heater is latched and not being checked
+
+        self.apply_settings(heaterSettings)
+
+    # Take the thresholds from a HeaterSettings, and update min/max to match them
+    def apply_settings(self, heaterSettings):
+        self.delay = heaterSettings.delay  # Delay before triggering a thermal runaway
+        self.maxDiff = heaterSettings.maxDiff  # Maximum allowed deviation from set temperature
+        self.maxOffTemp = heaterSettings.maxOffTemp  # Maximum allowed temp while the heater is turned off
+        self.maxRiseRate = heaterSettings.maxRiseRate  # Fastest the temp may rise once it's well above the set temp
+        self.minHeatRate = heaterSettings.minHeatRate  # Slowest the temp may rise while it's well below the set temp
+        self.history.window = heaterSettings.rateWindow
+        self.update_thresholds()
+
+    # Work out min/max for the current set temp
+    def update_thresholds(self):
+        if self.set > 0.0:
+            # Heater is turned on, allow maxDiff either side of the set temp
+            self.max = self.set + self.maxDiff
+            self.min = self.set - self.maxDiff
+        elif self.set == self.set:
+            # Heater is turned off, allow anything up to maxOffTemp
+            self.max = self.maxOffTemp
+            self.min = 0.0
+
+    # Store a new set temp, returns False if it hasn't changed
+    def update_target_temp_range(self, newSetTemp):
+        if self.set == newSetTemp:
+            # hasn't changed, no need to update
+            return False
+
+        self.set = newSetTemp
+        self.setChanged = self.received
+
+        # reset high/low to current
+        self.low = self.current
+        self.high = self.current
+
+        # reset warnings when setpoint changes
+        self.warningLow = 0
+        self.warningHigh = 0
+        self.rateWarning = 0
+        self.modelWarning = 0
+
+        self.update_thresholds()
+        return True
+
+    # Store the time of a new report, keeping track of the longest gap between reports
+    def update_received(self, received):
+        if self.reports and received - self.received > self.maxGap:
+            self.maxGap = received - self.received
+        self.received = received
+        self.reports += 1
+
+    # Time that the heater went too low/high, direction = low/high
+    def get_warning(self, direction):
+        return self.warningLow if direction == 'low' else self.warningHigh
+
+    def set_warning(self, direction, value):
+        if direction == 'low':
+            self.warningLow = value
+        else:
+            self.warningHigh = value
+
+    # LogThrottle for the still too low/high warnings, direction = low/high
+    def get_log_throttle(self, direction):
+        return self.logLow if direction == 'low' else self.logHigh
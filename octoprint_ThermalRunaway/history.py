@@ -0,0 +1,111 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+# Import array. Samples are stored in flat arrays of doubles rather than lists of tuples
+from array import array
+
+
+class HeaterHistory(object):
+    # Fixed size ring buffer of (time, current, set) samples for one heater, plus a least squares fit of current
+    # against time over the last `window` seconds. Adding a sample updates the fit in O(1) (amortised), so the
+    # slope is always ready without going back over the samples
+    __slots__ = ('capacity', 'window', 'times', 'currents', 'sets', 'start', 'count', 'windowStart',
+                 'base', 'n', 'sumX', 'sumY', 'sumXX', 'sumXY', 'sinceRefresh')
+
+    def __init__(self, capacity=128, window=10.0):
+        self.capacity = capacity
+        self.window = window  # Length in seconds of the window the slope is calculated over
+        self.times = array('d', [0.0]) * capacity
+        self.currents = array('d', [0.0]) * capacity
+        self.sets = array('d', [0.0]) * capacity
+        self.clear()
+
+    # Throw away every sample
+    def clear(self):
+        self.start = 0  # Index of the oldest sample in the buffer
+        self.count = 0  # Number of samples in the buffer
+        self.windowStart = 0  # Index of the oldest sample inside the window
+        self.base = 0.0  # Times are stored in the sums relative to this, to keep the sums small
+        self.n = 0  # Number of samples inside the window
+        self.sumX = 0.0
+        self.sumY = 0.0
+        self.sumXX = 0.0
+        self.sumXY = 0.0
+        self.sinceRefresh = 0  # Samples added since the sums were last recalculated from scratch
+
+    # Add a sample, dropping the oldest one if the buffer is full
+    def add(self, time, current, setTemp):
+        capacity = self.capacity
+        if self.count == 0:
+            self.base = time
+
+        if self.count == capacity:
+            # Buffer is full, the oldest sample goes. Take it out of the window first if it is still in there
+            if self.n and self.windowStart == self.start:
+                self._remove_from_window()
+            self.start = (self.start + 1) % capacity
+            self.count -= 1
+
+        index = (self.start + self.count) % capacity
+        self.times[index] = time
+        self.currents[index] = current
+        self.sets[index] = setTemp
+        self.count += 1
+
+        if self.n == 0:
+            self.windowStart = index
+        x = time - self.base
+        self.n += 1
+        self.sumX += x
+        self.sumY += current
+        self.sumXX += x * x
+        self.sumXY += x * current
+
+        # Drop samples that have fallen out of the back of the window
+        oldest = time - self.window
+        while self.n > 1 and self.times[self.windowStart] < oldest:
+            self._remove_from_window()
+
+        # Adding and taking away from the sums slowly loses precision, so every so often start them again
+        self.sinceRefresh += 1
+        if self.sinceRefresh >= capacity:
+            self._refresh()
+
+    def _remove_from_window(self):
+        index = self.windowStart
+        x = self.times[index] - self.base
+        y = self.currents[index]
+        self.n -= 1
+        self.sumX -= x
+        self.sumY -= y
+        self.sumXX -= x * x
+        self.sumXY -= x * y
+        self.windowStart = (index + 1) % self.capacity
+
+    # Recalculate the sums from the samples inside the window, relative to the oldest of them
+    def _refresh(self):
+        self.sinceRefresh = 0
+        if self.n == 0:
+            return
+        self.base = self.times[self.windowStart]
+        sumX = sumY = sumXX = sumXY = 0.0
+        index = self.windowStart
+        for i in range(0, self.n):
+            x = self.times[index] - self.base
+            y = self.currents[index]
+            sumX += x
+            sumY += y
+            sumXX += x * x
+            sumXY += x * y
+            index = (index + 1) % self.capacity
+        self.sumX, self.sumY, self.sumXX, self.sumXY = sumX, sumY, sumXX, sumXY
+
+    # Rate of change of the temperature over the window in degrees per second, NaN if there isn't enough to go on
+    def slope(self):
+        n = self.n
+        if n < 3:
+            return float('NaN')
+        denominator = n * self.sumXX - self.sumX * self.sumX
+        if denominator <= 0.0:
+            return float('NaN')
+        return (n * self.sumXY - self.sumX * self.sumY) / denominator
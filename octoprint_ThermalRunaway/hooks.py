@@ -0,0 +1,171 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+# Import deque. Used for the calls waiting on a handler that is still busy with the last one
+from collections import deque
+# Import threading. Used for the cache lock and the thread that watches for handlers that take too long
+import threading
+# Import time. Used to measure how long each handler takes
+import time
+
+
+class HandlerStats(object):
+    # Timings and counters for one registered handler
+    __slots__ = ('hook', 'plugin', 'calls', 'failures', 'timeouts', 'queued', 'skipped', 'running', 'backlog',
+                 'lastDuration', 'maxDuration', 'totalDuration')
+
+    def __init__(self, hook, plugin):
+        self.hook = hook
+        self.plugin = plugin
+        self.calls = 0  # Number of times the handler has finished, successfully or not
+        self.failures = 0  # Number of times the handler raised an exception
+        self.timeouts = 0  # Number of times the handler ran for longer than the timeout
+        self.queued = 0  # Number of calls that had to wait for the previous call to finish
+        self.skipped = 0  # Number of calls skipped because the handler was hung or its backlog was full
+        self.running = None  # Time the current call started, None if it isn't running
+        self.backlog = deque()  # Arguments of the calls waiting for the current call to finish
+        self.lastDuration = None
+        self.maxDuration = None
+        self.totalDuration = 0.0
+
+    def as_dict(self):
+        return dict(hook=self.hook, plugin=self.plugin, calls=self.calls, failures=self.failures,
+                    timeouts=self.timeouts, queued=self.queued, skipped=self.skipped, running=self.running is not None,
+                    lastDuration=self.lastDuration, maxDuration=self.maxDuration,
+                    meanDuration=self.totalDuration / self.calls if self.calls else None)
+
+
+class HookDispatcher(object):
+    # Calls the handlers registered for our hooks on a shared pool of threads, caching the hook lookups and
+    # keeping track of how long each handler takes. A handler is only called for one event at a time, any that come in
+    # while it is busy wait in its backlog and are called in order once it returns
+    def __init__(self, plugin_manager, logger, timeout=10.0, workers=4, backlog=8):
+        self._plugin_manager = plugin_manager
+        self.logger = logger
+        self.timeout = timeout  # Seconds a handler may run for before it is reported as hung
+        self.workers = workers
+        self.backlogSize = backlog  # Calls that may wait on a busy handler, any more are skipped
+
+        self._lock = threading.Lock()
+        self._cache = {}  # hook name -> list of (plugin name, handler)
+        self._stats = {}  # (hook name, plugin name) -> HandlerStats
+        self._executor = None
+        self._watcher = None
+
+    # Forget the cached hook lookups, called when plugins are installed, removed, enabled or disabled
+    def invalidate(self):
+        with self._lock:
+            self._cache = {}
+        self.logger.debug('Cleared cached hook handlers')
+
+    # Get the handlers registered for a hook, only asking the plugin manager if we haven't already
+    def get_handlers(self, hook):
+        handlers = self._cache.get(hook)
+        if handlers is None:
+            handlers = sorted(self._plugin_manager.get_hooks(hook).items())
+            with self._lock:
+                self._cache[hook] = handlers
+        return handlers
+
+    # Call every handler registered for a hook with args, without waiting for any of them to finish
+    def dispatch(self, hook, args):
+        for name, handler in self.get_handlers(hook):
+            with self._lock:
+                stats = self._stats.get((hook, name))
+                if stats is None:
+                    stats = self._stats[(hook, name)] = HandlerStats(hook, name)
+                if stats.running is not None:
+                    # The last call still hasn't finished, don't tie up another thread with it. Unless the handler is
+                    # hung, call it again once it returns
+                    if time.time() - stats.running > self.timeout:
+                        stats.skipped += 1
+                        self.logger.warning('Not calling %s handler from %s, it has been running for more than %s '
+                                            'seconds', hook, name, self.timeout)
+                    elif len(stats.backlog) >= self.backlogSize:
+                        stats.skipped += 1
+                        self.logger.warning('Not calling %s handler from %s, %s calls are already waiting for it',
+                                            hook, name, len(stats.backlog))
+                    else:
+                        stats.queued += 1
+                        stats.backlog.append(args)
+                    continue
+                stats.running = time.time()
+                if self._executor is None:
+                    # Import concurrent.futures. Handlers are run on a small shared pool rather than a thread each.
+                    # Only imported once there is something to run, so that loading the plugin stays quick
+                    import concurrent.futures
+                    self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers,
+                                                                           thread_name_prefix="ThermalRunaway hook")
+            try:
+                self._executor.submit(self._call, stats, handler, args)
+            except Exception as e:
+                # Log that something went wrong
+                with self._lock:
+                    stats.running = None
+                self.logger.exception("Exception while calling the {} handler from {}: {}".format(hook, name, e))
+        self._start_watcher()
+
+    # Runs on the pool, calls a single handler and records how it went, then makes any calls that were waiting for it
+    def _call(self, stats, handler, args):
+        while args is not None:
+            failed = False
+            try:
+                handler(*args)
+            except Exception:
+                failed = True
+                self.logger.exception('%s handler from %s raised an exception', stats.hook, stats.plugin)
+            finally:
+                with self._lock:
+                    duration = time.time() - stats.running
+                    stats.calls += 1
+                    stats.failures += 1 if failed else 0
+                    stats.lastDuration = duration
+                    stats.maxDuration = duration if stats.maxDuration is None else max(stats.maxDuration, duration)
+                    stats.totalDuration += duration
+                    if stats.backlog:
+                        args = stats.backlog.popleft()
+                        stats.running = time.time()
+                    else:
+                        args = None
+                        stats.running = None
+                self.logger.info('%s handler from %s finished in %.3f seconds', stats.hook, stats.plugin, duration)
+
+    # Start the thread that reports handlers running for longer than the timeout, if it isn't already running
+    def _start_watcher(self):
+        with self._lock:
+            if self._watcher is not None and self._watcher.is_alive():
+                return
+            self._watcher = threading.Thread(target=self._watch, name="ThermalRunaway hook watcher")
+            self._watcher.daemon = True
+            self._watcher.start()
+
+    # Check on running handlers until none are left, then exit
+    def _watch(self):
+        reported = set()
+        while True:
+            now = time.time()
+            with self._lock:
+                running = [stats for stats in self._stats.values() if stats.running is not None]
+                for stats in running:
+                    key = (stats.hook, stats.plugin, stats.running)
+                    if key not in reported and now - stats.running > self.timeout:
+                        reported.add(key)
+                        stats.timeouts += 1
+                        self.logger.error('%s handler from %s has been running for more than %s seconds',
+                                          stats.hook, stats.plugin, self.timeout)
+                if not running:
+                    self._watcher = None
+                    return
+            time.sleep(min(0.5, self.timeout))
+
+    # Timings and counters for every handler that has been called
+    def stats(self):
+        with self._lock:
+            return [stats.as_dict() for stats in self._stats.values()]
+
+    # Stop accepting new calls, handlers that are already running are left to finish on their own
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
@@ -0,0 +1,132 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+# Live updates of the state of each heater for the UI, sent over OctoPrint's socket as plugin messages.
+#
+# Every message is {"type": "heaters", "seq": n, "time": <report time>, "heaters": {<heater>: {<changed fields>}}},
+# with only the heaters and fields that have changed since the last message. The fields of a heater are:
+#     current, set, min, max: temps, rounded to 0.1C, None if not known
+#     state: off, ok, low, high, rate, model or tripped
+#     tripAt: report time at which the current warning will be caught as a thermal runaway, None if not in warning
+# Messages go out at most once every interval seconds, except that a heater changing state is sent straight away.
+# The full state, with the seq of the last message sent, is included in the status API so that a client can start
+# from it and apply the messages that follow. A client that sees a gap in seq should fetch the full state again.
+
+# Import floor. Rounding with it is several times faster than round(value, 1), and this runs for every report
+from math import floor
+
+STATE_OFF = 'off'
+STATE_OK = 'ok'
+STATE_LOW = 'low'
+STATE_HIGH = 'high'
+STATE_RATE = 'rate'
+STATE_MODEL = 'model'
+STATE_TRIPPED = 'tripped'
+
+
+def _round(value):
+    return None if value != value else floor(value * 10.0 + 0.5) / 10.0
+
+
+# State of a heater as shown in the UI, the most serious first
+def heater_state_name(heater):
+    if heater.tripped:
+        return STATE_TRIPPED
+    if heater.warningLow:
+        return STATE_LOW
+    if heater.warningHigh:
+        return STATE_HIGH
+    if heater.rateWarning:
+        return STATE_RATE
+    if heater.modelWarning:
+        return STATE_MODEL
+    if heater.set > 0.0:
+        return STATE_OK
+    return STATE_OFF
+
+
+# Fields sent for each heater, in the order heater_view returns them
+FIELDS = ('current', 'set', 'min', 'max', 'state', 'tripAt')
+
+
+# Everything the UI shows for a heater, as a tuple in the order of FIELDS. confirm is the rateConfirm setting
+def heater_view(heater, confirm):
+    state = heater_state_name(heater)
+    if state == STATE_LOW:
+        tripAt = heater.warningLow + int(heater.delay)
+    elif state == STATE_HIGH:
+        tripAt = heater.warningHigh + int(heater.delay)
+    elif state == STATE_RATE:
+        tripAt = heater.rateWarning + confirm
+    elif state == STATE_MODEL:
+        tripAt = heater.modelWarning + confirm
+    else:
+        tripAt = None
+    return _round(heater.current), _round(heater.set), _round(heater.min), _round(heater.max), state, tripAt
+
+
+class LivePublisher(object):
+    # Works out what has changed after each report and sends it, no more than once every interval seconds unless a
+    # heater has changed state. Only called from the evaluator, send is called on the evaluator's thread
+    def __init__(self, send, logger, interval=2.0, confirm=3.0):
+        self.send = send
+        self.logger = logger
+        self.interval = interval  # Minimum seconds between messages that don't include a change of state
+        self.confirm = confirm  # rateConfirm setting, used to work out tripAt for rate and model warnings
+
+        self._sent = {}  # heater -> view as last sent, as a tuple from heater_view
+        self.lastSent = None  # Report time that the heaters were last compared with what was sent
+        self.seq = 0  # Number of the last message sent
+
+        # Counters
+        self.messages = 0  # Messages sent
+        self.failed = 0  # Messages that raised an exception when sent
+
+    # Compare the heaters with what was last sent and send any changes. Called after each report has been evaluated,
+    # the messages are timed by the newest report. Returns True if a message was sent
+    def publish(self, heaters):
+        sent = self._sent
+        now = 0.0
+        changedState = False
+        for heater in heaters:
+            if heater.received > now:
+                now = heater.received
+            if not changedState:
+                last = sent.get(heater.name)
+                changedState = last is None or last[4] != heater_state_name(heater)
+
+        lastSent = self.lastSent
+        if not changedState and lastSent is not None and lastSent <= now < lastSent + self.interval:
+            # Not due yet, only a change of state is sent early
+            return False
+
+        self.lastSent = now
+        changes = {}
+        for heater in heaters:
+            view = heater_view(heater, self.confirm)
+            last = sent.get(heater.name)
+            if last is None:
+                changes[heater.name] = dict(zip(FIELDS, view))
+            elif last != view:
+                changes[heater.name] = dict((key, value) for key, value, old in zip(FIELDS, view, last) if value != old)
+            else:
+                continue
+            sent[heater.name] = view
+        if not changes:
+            return False
+
+        self.seq += 1
+        try:
+            self.send(dict(type='heaters', seq=self.seq, time=now, heaters=changes))
+        except Exception as e:
+            # Clients will see the gap in seq and fetch the full state again
+            self.failed += 1
+            self.logger.exception("Exception while sending live update: {}".format(e))
+            return False
+        self.messages += 1
+        return True
+
+    # The full state of every heater as last sent, with the seq of the message it was sent in
+    def snapshot(self):
+        return dict(seq=self.seq, time=self.lastSent,
+                    heaters=dict((name, dict(zip(FIELDS, view))) for name, view in list(self._sent.items())))
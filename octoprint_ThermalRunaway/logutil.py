@@ -0,0 +1,26 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+
+class LogThrottle(object):
+    # Keeps track of a repeating log message so that it is only written once every interval seconds,
+    # with a count of how many times it was held back in between
+    __slots__ = ('lastLogged', 'suppressed')
+
+    def __init__(self):
+        self.reset()
+
+    # Forget about any previous messages, the next one will be logged straight away
+    def reset(self, now=0):
+        self.lastLogged = now
+        self.suppressed = 0
+
+    # Check whether the message should be logged now. Returns the number of messages held back since the last one
+    # that was logged, or -1 if this one should be held back as well
+    def ready(self, now, interval):
+        if now - self.lastLogged >= interval:
+            suppressed = self.suppressed
+            self.reset(now)
+            return suppressed
+        self.suppressed += 1
+        return -1
@@ -0,0 +1,156 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+# Turns the status returned by ThermalRunawayPlugin.get_status into the Prometheus text exposition format
+
+import collections
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, _escape(value)) for key, value in labels) + '}'
+
+
+def _number(value):
+    if value is None or value != value:
+        return 'NaN'
+    if value is True or value is False:
+        return '1' if value else '0'
+    return repr(float(value))
+
+
+class _Writer(object):
+    # Collects metric lines grouped by metric, since Prometheus wants all of the samples for a metric together
+    def __init__(self):
+        self.metrics = collections.OrderedDict()
+
+    def _metric(self, name, metricType, description):
+        lines = self.metrics.get(name)
+        if lines is None:
+            lines = self.metrics[name] = ['# HELP {} {}'.format(name, description),
+                                          '# TYPE {} {}'.format(name, metricType)]
+        return lines
+
+    def add(self, name, metricType, description, value, labels=None):
+        self._metric(name, metricType, description).append('{}{} {}'.format(name, _labels(labels), _number(value)))
+
+    def histogram(self, name, description, histogram):
+        lines = self._metric(name, 'histogram', description)
+        for bound, count in histogram['buckets']:
+            lines.append('{}_bucket{} {}'.format(name, _labels([('le', bound)]), count))
+        lines.append('{}_sum {}'.format(name, _number(histogram['sum'])))
+        lines.append('{}_count {}'.format(name, histogram['count']))
+
+    def text(self):
+        return '\n'.join(line for lines in self.metrics.values() for line in lines) + '\n'
+
+
+def format_prometheus(status):
+    out = _Writer()
+
+    for heater in status['heaters']:
+        labels = [('heater', heater['name']), ('class', heater['class'])]
+        out.add('thermalrunaway_heater_temperature_celsius', 'gauge', 'Last reported temperature',
+                heater['current'], labels)
+        out.add('thermalrunaway_heater_target_celsius', 'gauge', 'Last reported set temperature',
+                heater['set'], labels)
+        out.add('thermalrunaway_heater_min_celsius', 'gauge', 'Lowest allowed temperature', heater['min'], labels)
+        out.add('thermalrunaway_heater_max_celsius', 'gauge', 'Highest allowed temperature', heater['max'], labels)
+        out.add('thermalrunaway_heater_rate_celsius_per_second', 'gauge', 'Rate of change of the temperature',
+                heater['rateOfChange'], labels)
+        out.add('thermalrunaway_heater_predicted_celsius', 'gauge',
+                'Temperature the heater model expects after the prediction horizon', heater['predicted'], labels)
+        for direction in ('low', 'high'):
+            out.add('thermalrunaway_heater_warning_seconds', 'gauge',
+                    'Seconds the heater has been too low/high, 0 if it is not',
+                    heater['warningAge'][direction] or 0, labels + [('direction', direction)])
+        out.add('thermalrunaway_heater_tripped', 'gauge', '1 if a thermal runaway has been caught on the heater',
+                heater['tripped'], labels)
+        out.add('thermalrunaway_heater_last_report_age_seconds', 'gauge', 'Seconds since the last report',
+                heater['lastReportAge'], labels)
+        out.add('thermalrunaway_heater_report_gap_max_seconds', 'gauge', 'Longest time between two reports',
+                heater['maxGap'], labels)
+        out.add('thermalrunaway_heater_reports_total', 'counter', 'Reports evaluated for the heater',
+                heater['reports'], labels)
+
+    reports = status['reports']
+    out.add('thermalrunaway_reports_received_total', 'counter', 'Temperature reports received from OctoPrint',
+            reports['received'])
+    out.add('thermalrunaway_reports_coalesced_total', 'counter',
+            'Heater readings replaced by a newer one before they were evaluated', reports['coalesced'])
+    out.add('thermalrunaway_reports_dropped_total', 'counter', 'Heater readings dropped because the queue was full',
+            reports['dropped'])
+    out.add('thermalrunaway_evaluations_total', 'counter', 'Batches of readings evaluated', reports['evaluated'])
+    out.add('thermalrunaway_evaluation_failures_total', 'counter', 'Batches that raised an exception',
+            reports['failed'])
+    out.add('thermalrunaway_report_gap_max_seconds', 'gauge', 'Longest time between two reports from OctoPrint',
+            reports['maxGap'])
+    out.histogram('thermalrunaway_evaluation_seconds', 'Time taken to evaluate a batch of readings',
+                  status['latency']['evaluation'])
+    out.histogram('thermalrunaway_queue_delay_seconds', 'Time readings waited before being evaluated',
+                  status['latency']['queueDelay'])
+
+    out.add('thermalrunaway_incidents_total', 'counter', 'Thermal runaways caught', status['incidentCount'])
+
+    emergency = status['emergency']
+    out.add('thermalrunaway_emergency_sent_total', 'counter', 'Times the emergency GCode has been sent',
+            emergency['fired'])
+    out.add('thermalrunaway_emergency_failures_total', 'counter', 'Emergency commands that raised an exception',
+            emergency['failed'])
+    out.histogram('thermalrunaway_emergency_seconds',
+                  'Time from a runaway being caught to the emergency GCode being handed over to be sent',
+                  emergency['latency'])
+
+    watchdog = status['watchdog']
+    out.add('thermalrunaway_reports_stale', 'gauge',
+            '1 while a heater that is turned on has gone longer than the timeout without a report',
+            1 if watchdog['stale'] else 0)
+    out.add('thermalrunaway_reports_stale_total', 'counter', 'Times the temperature reports have gone stale',
+            watchdog['fired'])
+
+    autoReport = status['autoReport']
+    out.add('thermalrunaway_autoreport_fast', 'gauge',
+            '1 while the temperature reports are sped up because a heater is in a warning',
+            1 if autoReport['fast'] else 0)
+    out.add('thermalrunaway_autoreport_commands_total', 'counter', 'M155 commands sent to change the report interval',
+            autoReport['sent'])
+
+    out.add('thermalrunaway_shared_state_writes_total', 'counter',
+            'Writes of the shared state read by the companion watchdog', status['sharedState']['writes'])
+
+    startup = status['startup']
+    out.add('thermalrunaway_import_seconds', 'gauge', 'Time taken to import the plugin', startup['importSeconds'])
+    if startup['initSeconds'] is not None:
+        out.add('thermalrunaway_initialize_seconds', 'gauge', 'Time taken to initialise the plugin',
+                startup['initSeconds'])
+
+    history = status['history']
+    out.add('thermalrunaway_history_records_written_total', 'counter', 'History records written to disk',
+            history['written'])
+    out.add('thermalrunaway_history_records_dropped_total', 'counter',
+            'History records dropped because they could not be written fast enough', history['dropped'])
+    out.add('thermalrunaway_history_write_failures_total', 'counter', 'History writes that raised an exception',
+            history['failed'])
+
+    for hook in status['hooks']:
+        labels = [('hook', hook['hook']), ('plugin', hook['plugin'])]
+        out.add('thermalrunaway_hook_calls_total', 'counter', 'Calls to a hook handler that have finished',
+                hook['calls'], labels)
+        out.add('thermalrunaway_hook_failures_total', 'counter', 'Hook handler calls that raised an exception',
+                hook['failures'], labels)
+        out.add('thermalrunaway_hook_timeouts_total', 'counter', 'Hook handler calls that ran past the timeout',
+                hook['timeouts'], labels)
+        out.add('thermalrunaway_hook_queued_total', 'counter',
+                'Hook handler calls that waited for the previous call to finish', hook['queued'], labels)
+        out.add('thermalrunaway_hook_skipped_total', 'counter',
+                'Hook handler calls skipped because the handler was hung or had too many calls waiting', hook['skipped'],
+                labels)
+        out.add('thermalrunaway_hook_duration_max_seconds', 'gauge', 'Longest a hook handler call has taken',
+                hook['maxDuration'], labels)
+
+    return out.text()
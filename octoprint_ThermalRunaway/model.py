@@ -0,0 +1,106 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+# Import math. Used for the closed form prediction
+import math
+
+# Number of samples the model has to learn from before it is trusted, to predict anything or to screen out updates
+MODEL_WARMUP = 30
+# Screened updates skip rates more than SCREEN_ERRORS times the smoothed error plus SCREEN_MIN_RATE C/s away from
+# what the model expected
+SCREEN_ERRORS = 4.0
+SCREEN_MIN_RATE = 0.5
+
+
+class ThermalModel(object):
+    # First order model of a heater under its firmware's control, learnt online from the reports:
+    #     dT/dt = a * (set - T) + b * T + c
+    # a is how hard the firmware drives the heater towards its set temp, b and c how it loses heat to its surroundings.
+    # The parameters are fitted with recursive least squares with a forgetting factor, so every report is an O(1)
+    # update of three parameters and a 3x3 covariance, with no history kept. Temps are scaled by 1/100 in the
+    # regressors to keep the covariance well conditioned
+    __slots__ = ('forgetting', 'maxTrace', 'a', 'b', 'c', 'p00', 'p01', 'p02', 'p11', 'p12', 'p22',
+                 'samples', 'error', 'lastTime', 'lastTemp', 'lastSet')
+
+    def __init__(self, forgetting=0.995, maxTrace=3000.0):
+        self.forgetting = forgetting  # Weight given to old samples on every update, lower forgets faster
+        self.maxTrace = maxTrace  # The covariance stops growing past this while the reports don't tell it anything new
+        self.reset()
+
+    # Forget everything that has been learnt
+    def reset(self):
+        self.a = self.b = self.c = 0.0
+        start = self.maxTrace / 3
+        self.p00, self.p01, self.p02 = start, 0.0, 0.0
+        self.p11, self.p12 = start, 0.0
+        self.p22 = start
+        self.samples = 0  # Number of samples the model has learnt from
+        self.error = float('NaN')  # Smoothed size of the difference between the predicted and reported rate, C/s
+        self.lastTime = None
+        self.lastTemp = 0.0
+        self.lastSet = 0.0
+
+    # Rate of change in C/s the model expects at temp with the heater set to setTemp
+    def rate(self, temp, setTemp):
+        return self.a * (setTemp - temp) / 100.0 + self.b * temp / 100.0 + self.c
+
+    # Temp the model expects the heater to be at in `ahead` seconds, starting from temp
+    def predict(self, temp, setTemp, ahead):
+        # dT/dt = alpha + beta * T, solved exactly rather than stepped
+        alpha = self.a * setTemp / 100.0 + self.c
+        beta = (self.b - self.a) / 100.0
+        if abs(beta) < 1e-9:
+            return temp + alpha * ahead
+        equilibrium = -alpha / beta
+        return equilibrium + (temp - equilibrium) * math.exp(beta * ahead)
+
+    # Add a report. The rate between this report and the last one is learnt, unless learn is False, in which case only
+    # the report is remembered. Reports more than maxGap seconds apart aren't learnt from.
+    # If screen is True, a rate that is far outside what the model has been getting wrong by lately isn't learnt
+    # either, so that a fault isn't learnt as normal before it has been caught
+    def update(self, time, temp, setTemp, learn=True, screen=False, maxGap=10.0):
+        lastTime, lastTemp, lastSet = self.lastTime, self.lastTemp, self.lastSet
+        self.lastTime, self.lastTemp, self.lastSet = time, temp, setTemp
+        if lastTime is None:
+            return
+        elapsed = time - lastTime
+        if not learn or elapsed <= 0.0 or elapsed > maxGap:
+            return
+
+        observed = (temp - lastTemp) / elapsed
+        x0 = (lastSet - lastTemp) / 100.0
+        x1 = lastTemp / 100.0
+        residual = observed - (self.a * x0 + self.b * x1 + self.c)
+        error = self.error
+        if error != error:
+            self.error = abs(residual)
+        elif screen and self.samples >= MODEL_WARMUP and abs(residual) > SCREEN_ERRORS * error + SCREEN_MIN_RATE:
+            # Too far out to learn from. Only let the error grow slowly, so that something that really has changed
+            # is learnt in the end, but a fault isn't learnt in the seconds it takes to catch it
+            self.error = 0.99 * error + 0.01 * (SCREEN_ERRORS * error + SCREEN_MIN_RATE)
+            return
+        else:
+            self.error = 0.95 * error + 0.05 * abs(residual)
+
+        # P x
+        px0 = self.p00 * x0 + self.p01 * x1 + self.p02
+        px1 = self.p01 * x0 + self.p11 * x1 + self.p12
+        px2 = self.p02 * x0 + self.p12 * x1 + self.p22
+        denominator = self.forgetting + x0 * px0 + x1 * px1 + px2
+        k0 = px0 / denominator
+        k1 = px1 / denominator
+        k2 = px2 / denominator
+
+        self.a += k0 * residual
+        self.b += k1 * residual
+        self.c += k2 * residual
+
+        # P = (P - K (P x)^T) / forgetting, without the division once P is as large as we allow it to get
+        scale = 1.0 / self.forgetting if self.p00 + self.p11 + self.p22 < self.maxTrace else 1.0
+        self.p00 = (self.p00 - k0 * px0) * scale
+        self.p01 = (self.p01 - k0 * px1) * scale
+        self.p02 = (self.p02 - k0 * px2) * scale
+        self.p11 = (self.p11 - k1 * px1) * scale
+        self.p12 = (self.p12 - k1 * px2) * scale
+        self.p22 = (self.p22 - k2 * px2) * scale
+        self.samples += 1
@@ -0,0 +1,32 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+# Parses temperature reports sent by the printer (M105 responses and auto reports) into the same
+# {heater: (current, set)} dict that OctoPrint passes to the temperatures received hook
+
+# Import re. The pattern is compiled once and reused for every line
+import re
+
+# Matches each heater in a report, eg. "T:210.0 /210.0", "B:60.1/60" or "T1:25.0". Heaters must follow the start of the
+# line or a space, so that "B@:0" and the like aren't picked up
+TEMPERATURE_PATTERN = re.compile(r'(?:^|(?<=\s))([TBC]\d*):\s*([-+]?\d*\.?\d+)(?:\s*/\s*([-+]?\d*\.?\d+))?')
+
+
+# Turn the (heater, current, set) matches of TEMPERATURE_PATTERN into a report.
+# A bare T is the active tool; it is reported as T0 on single tool printers, and ignored when the tools are also listed
+# with their numbers
+def build_report(found):
+    temps = {}
+    for heater, current, target in found:
+        temps[heater] = (float(current), float(target) if target else None)
+
+    if 'T' in temps:
+        active = temps.pop('T')
+        if 'T0' not in temps:
+            temps['T0'] = active
+    return temps
+
+
+# Parse a temperature report line, returns an empty dict if the line doesn't contain one
+def parse_temperature_line(line):
+    return build_report(TEMPERATURE_PATTERN.findall(line))
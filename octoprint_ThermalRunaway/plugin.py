@@ -0,0 +1,512 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+# Import time. This is so that we can add delays to parts of the code, and to time how long the plugin takes to load
+import time
+# Time the plugin started loading
+IMPORT_STARTED = time.perf_counter()
+
+# Import the core OctoPrint plugin components
+import octoprint.plugin
+# Import logging to allow for easier debugging
+import logging
+# Import os. Used to find the history folder
+import os
+
+# Import flask. This is used to respond to API requests
+import flask
+# Import OctoPrint's permissions. Used to check who is allowed to read the status and to reset a runaway
+from octoprint.access.permissions import Permissions
+
+# Import the evaluator. This is used to process the temps asynchronously so
+# that we don't block OctoPrints communications with the printer
+from .worker import ReportQueue, EvaluationWorker
+# Import the settings snapshot. This saves us from reading and parsing the settings on every report
+from .settings import build_snapshot, SETTINGS_DEFAULTS
+# Import the engine. This does the actual checking of the temps
+from .engine import MonitorEngine
+# Import the hook dispatcher. This is used to call registered hooks without blocking the evaluator
+from .hooks import HookDispatcher
+# Import the Prometheus formatter, used for the metrics endpoint
+from .metrics import format_prometheus
+# Import the history store. Used to keep every report on disk
+from .store import HistoryStore
+# Import the emergency action. Used to get the emergency GCode to the printer as fast as possible
+from .emergency import EmergencyAction
+# Import the watchdog. Used to catch the temperature reports stopping
+from .watchdog import StaleWatchdog
+# Import the live publisher. Used to keep the UI up to date with the state of each heater
+from .live import LivePublisher
+# Import the auto report controller. Used to speed up the temperature reports while a heater is in a warning
+from .autoreport import AutoReportController, COMMAND_TAGS as AUTOREPORT_TAGS
+# Import the shared state publisher. Used to let the companion watchdog watch the heaters from another process
+from .sharedstate import StatePublisher, default_path as default_shared_state_path
+
+# Seconds it took to import the plugin and everything it needs that OctoPrint hadn't already loaded
+IMPORT_SECONDS = time.perf_counter() - IMPORT_STARTED
+
+
+class ThermalRunawayPlugin(octoprint.plugin.ShutdownPlugin,
+                           octoprint.plugin.SettingsPlugin,
+                           octoprint.plugin.TemplatePlugin,
+                           octoprint.plugin.AssetPlugin,
+                           octoprint.plugin.SimpleApiPlugin,
+                           octoprint.plugin.BlueprintPlugin,
+                           octoprint.plugin.EventHandlerPlugin,
+                           octoprint.plugin.RestartNeedingPlugin):
+
+    def __init__(self):
+        # This allows us to store and display our logs with the rest of the OctoPrint logs
+        self.logger = logging.getLogger('octoprint.plugins.ThermalRunaway')
+
+        # Queue that get_temps hands reports to, and the thread that evaluates them
+        self.reportQueue = ReportQueue()
+        self.evaluationWorker = EvaluationWorker(self.reportQueue, self.check_temps, self.logger)
+
+        # Sends the emergency GCode, get_temps passes it the comm object so that it can skip the command queue
+        self.emergencyAction = EmergencyAction(None, self.logger)
+
+        # Seconds initialize took, None until it has run
+        self.initSeconds = None
+        return
+
+    # Function that OctoPrint calls as soon as it has given us our settings, printer and plugin manager, before
+    # the server starts and long before on_after_startup on a slow machine. The printer can connect and start
+    # reporting temps before on_after_startup, so everything needed to check them is set up here. The state of each
+    # heater is only created when the heater is first reported
+    def initialize(self):
+        started = time.perf_counter()
+
+        # Read and parse the settings once, the evaluator only ever looks at this snapshot
+        self.settingsSnapshot = build_snapshot(self._settings, self.logger)
+        settings = self.settingsSnapshot
+
+        # Create the engine that checks the temps, it calls runaway_triggered once for each runaway it catches
+        self.engine = MonitorEngine(settings, self.logger, self.runaway_triggered)
+
+        # Check what GCode the user has specified to send in the event of a thermal runaway
+        self.emergencyGCode = settings.emergencyGcode
+        self.emergencyAction.printer = self._printer
+
+        # Create the dispatcher used to call the plugins registered for our hooks
+        self.hookDispatcher = HookDispatcher(self._plugin_manager, self.logger, timeout=settings.hookTimeout)
+
+        # Create the store that keeps the history of every heater in the plugin data folder
+        self.historyStore = HistoryStore(os.path.join(self.get_plugin_data_folder(), "history"), self.logger)
+        self.apply_history_settings(settings)
+
+        # Create the watchdog that catches the reports stopping while a heater is on
+        self.staleWatchdog = StaleWatchdog(self.engine, self.logger, self.reports_stale)
+        self.apply_watchdog_settings(settings)
+
+        # Create the publisher that sends the state of each heater to the UI as it changes
+        self.livePublisher = LivePublisher(self.send_live_update, self.logger, interval=settings.liveInterval,
+                                           confirm=settings.rateConfirm)
+
+        # Create the controller that speeds up the temperature reports while a heater is in a warning, the engine tells
+        # it when a heater goes into one
+        self.autoReport = AutoReportController(self.send_autoreport_command, self.logger)
+        self.apply_autoreport_settings(settings)
+        self.engine.on_warning = self.autoReport.warning
+
+        # Create the publisher that shares the state of each heater with the companion watchdog
+        self.statePublisher = None
+        self.apply_shared_state_settings(settings)
+
+        # Start evaluating the temps that get_temps has queued up
+        self.evaluationWorker.start()
+
+        self.initSeconds = time.perf_counter() - started
+        self.logger.info('Thermal Runaway protection active, plugin imported in %.1f ms and initialised in %.1f ms',
+                         IMPORT_SECONDS * 1000, self.initSeconds * 1000)
+        return
+
+    ########################
+    # ShutdownPlugin Mixin #
+    ########################
+    # Function to run when OctoPrint shuts down, used to stop the evaluator thread
+    def on_shutdown(self):
+        self.staleWatchdog.stop()
+        self.evaluationWorker.stop()
+        if self.statePublisher is not None:
+            self.statePublisher.stop()
+        self.hookDispatcher.shutdown()
+        self.engine.recorder = None
+        self.historyStore.stop()
+        self.logger.info("Evaluator stopped. {r} reports received, {c} coalesced, {d} dropped, {e} batches evaluated"
+                         .format(r=self.reportQueue.received,
+                                 c=self.reportQueue.coalesced,
+                                 d=self.reportQueue.dropped,
+                                 e=self.evaluationWorker.evaluated))
+        return
+
+    ########################
+    # SettingsPlugin Mixin #
+    ########################
+    # Function to return the default values for all settings for this plugin
+    def get_settings_defaults(self):
+        # Define default settings for this plugin
+        return dict(SETTINGS_DEFAULTS)
+
+    # Function to run when the user saves the settings, used to rebuild the settings snapshot
+    def on_settings_save(self, data):
+        diff = octoprint.plugin.SettingsPlugin.on_settings_save(self, data)
+        # Swap in a new snapshot, the evaluator picks it up on the next report
+        self.settingsSnapshot = build_snapshot(self._settings, self.logger)
+        self.engine.settings = self.settingsSnapshot
+        self.emergencyGCode = self.settingsSnapshot.emergencyGcode
+        self.hookDispatcher.timeout = self.settingsSnapshot.hookTimeout
+        self.apply_history_settings(self.settingsSnapshot)
+        self.apply_watchdog_settings(self.settingsSnapshot)
+        self.livePublisher.interval = self.settingsSnapshot.liveInterval
+        self.livePublisher.confirm = self.settingsSnapshot.rateConfirm
+        self.apply_autoreport_settings(self.settingsSnapshot)
+        self.apply_shared_state_settings(self.settingsSnapshot)
+        self.logger.debug('Settings saved, rebuilt settings snapshot')
+        return diff
+
+    ########################
+    # TemplatePlugin Mixin #
+    ########################
+    # Function to inform OctoPrint what parts of the UI we will be binding to
+    def get_template_configs(self):
+        # Tell OctoPrint that we have a settings page, and a sidebar panel showing the state of each heater
+        return [
+            dict(type="settings", custom_bindings=False),
+            dict(type="sidebar", name="Thermal Runaway", icon="fire", custom_bindings=True)
+        ]
+
+    #####################
+    # AssetPlugin Mixin #
+    #####################
+    # Function to tell OctoPrint what static files the UI needs
+    def get_assets(self):
+        return dict(
+            js=["js/ThermalRunaway.js"],
+            css=["css/ThermalRunaway.css"]
+        )
+
+    #########################
+    # SimpleApiPlugin Mixin #
+    #########################
+    # Function to tell OctoPrint what API commands we accept
+    def get_api_commands(self):
+        return dict(
+            reset=[]  # Clear a caught runaway, optionally takes the id of the heater to reset
+        )
+
+    # Function to handle API commands
+    def on_api_command(self, command, data):
+        if command == "reset":
+            # Resetting a runaway lets the heaters be turned back on, so needs the same rights as controlling the printer
+            if not Permissions.CONTROL.can():
+                return flask.make_response("Insufficient rights", 403)
+            heaters = self.engine.reset_runaway(data.get("heater"))
+            return flask.jsonify(reset=heaters)
+
+    # Function to handle GET requests to the API, returns the current status of the plugin, or with
+    # ?history=<heater>&minutes=<N> the stored history of a heater for the last N minutes (10 by default)
+    def on_api_get(self, request):
+        heater = request.values.get("history")
+        if heater is not None:
+            if not Permissions.MONITOR.can():
+                return flask.make_response("Insufficient rights", 403)
+            try:
+                minutes = float(request.values.get("minutes", 10))
+            except ValueError:
+                return flask.make_response("minutes must be a number", 400)
+            return flask.jsonify(self.get_history(heater, minutes))
+        if not Permissions.STATUS.can():
+            return flask.make_response("Insufficient rights", 403)
+        return flask.jsonify(self.get_status())
+
+    #########################
+    # BlueprintPlugin Mixin #
+    #########################
+    # Status in the Prometheus text format, at /plugin/ThermalRunaway/metrics
+    @octoprint.plugin.BlueprintPlugin.route("/metrics", methods=["GET"])
+    def get_metrics(self):
+        if not Permissions.STATUS.can():
+            return flask.make_response("Insufficient rights", 403)
+        return flask.Response(format_prometheus(self.get_status()), mimetype="text/plain; version=0.0.4")
+
+    def is_blueprint_csrf_protected(self):
+        return True
+
+    ############################
+    # EventHandlerPlugin Mixin #
+    ############################
+    # Function to handle OctoPrint events
+    def on_event(self, event, payload):
+        # Plugins being installed, uninstalled, enabled or disabled can change who is registered for our hooks
+        if event.startswith("plugin_pluginmanager_"):
+            self.hookDispatcher.invalidate()
+        # The reports stop when the printer is disconnected, that isn't a stall
+        elif event in ("Disconnected", "Error"):
+            self.staleWatchdog.disarm()
+            # Tell the companion watchdog too, otherwise it would take the reports stopping for a stall
+            statePublisher = self.statePublisher
+            if statePublisher is not None:
+                statePublisher.disarm(self.staleWatchdog.disarmedAt)
+            # The next printer to connect may not be the same firmware, and OctoPrint sets its auto report interval
+            # up again when it connects
+            self.autoReport.reset()
+
+    ##############################
+    # Temperatures Received Hook #
+    ##############################
+    # Temperatures hook
+    def get_temps(self, comm, parsed_temps):
+        # Wrap everything in a try-except-finally statement to ensure that we always pass the temps to OctoPrint
+        try:
+            # Keep hold of the comm object, the emergency GCode is sent straight to it
+            self.emergencyAction.comm = comm
+            # Queue the received temps for the evaluator thread to ensure that we don't block communications to the
+            # printer. Only the latest report for each heater is kept if the evaluator falls behind
+            self.reportQueue.put(parsed_temps, time.time())
+        except Exception as e:
+            # Log that something went wrong
+            self.logger.error("Exception in get_temps: {}".format(e))
+        finally:
+            # log that we have reached the end of this function
+            self.logger.debug('Reached end of get_temps')
+            return parsed_temps  # return the temps to OctoPrint
+
+    #############################
+    # Firmware Capability Hook #
+    #############################
+    # Capabilities hook, called for each capability the firmware lists in its M115 response
+    def firmware_capability(self, comm_instance, capability, enabled, already_defined):
+        try:
+            self.autoReport.capability(capability, enabled)
+        except Exception as e:
+            # Log that something went wrong
+            self.logger.error("Exception in firmware_capability: {}".format(e))
+
+    ####################
+    # Custom functions #
+    ####################
+    # Function to process temperatures received from the printer and check for a thermal runaway
+    # temps is keyed by heater, each value is (current, set, time received)
+    def check_temps(self, temps):
+        self.engine.evaluate(temps)
+        # Send the UI anything that has changed
+        self.livePublisher.publish(self.engine.heaters)
+        # Only while a heater is, or has just been, in a warning
+        if self.autoReport.active:
+            self.autoReport.update(self.engine.heaters)
+        # Only while the companion watchdog is turned on
+        statePublisher = self.statePublisher
+        if statePublisher is not None:
+            statePublisher.publish(self.engine.heaters)
+
+    # Function to send the M155 commands that change the temperature auto report interval
+    def send_autoreport_command(self, command):
+        self._printer.commands(command, tags=AUTOREPORT_TAGS)
+
+    # Function to pass on the auto report settings, along with whether OctoPrint uses auto reporting and the interval
+    # it asks the firmware for
+    def apply_autoreport_settings(self, settings):
+        autoReport = self.autoReport
+        autoReport.enabled = settings.adaptiveAutoReport
+        autoReport.fast = settings.autoReportFast
+        # OctoPrint only sets up auto reporting if it is turned on in its serial settings, otherwise it polls with M105
+        autoReport.allowed = self._settings.global_get_boolean(["serial", "capabilities", "autoreport_temp"])
+        if not (autoReport.enabled and autoReport.allowed) and autoReport.isFast:
+            # Put the interval back on the next report
+            autoReport.wanted = False
+            autoReport.active = True
+        interval = self._settings.global_get_float(["serial", "timeout", "temperatureAutoreport"])
+        if interval:
+            autoReport.interval = interval
+
+    # Function to send a live update to the UI
+    def send_live_update(self, data):
+        self._plugin_manager.send_plugin_message(self._identifier, data)
+
+    # Function to gather everything we know about the heaters, the evaluator and the hooks. Only reads values that the
+    # evaluator writes, so it doesn't need to take any locks and doesn't hold the evaluator up
+    def get_status(self):
+        return dict(
+            heaters=self.engine.heater_status(),
+            reports=dict(
+                received=self.reportQueue.received,
+                coalesced=self.reportQueue.coalesced,
+                dropped=self.reportQueue.dropped,
+                evaluated=self.evaluationWorker.evaluated,
+                failed=self.evaluationWorker.failed,
+                maxGap=self.reportQueue.maxGap
+            ),
+            latency=dict(
+                evaluation=self.evaluationWorker.latency.snapshot(),
+                queueDelay=self.evaluationWorker.queueDelay.snapshot()
+            ),
+            incidents=list(self.engine.incidents),
+            incidentCount=self.engine.incidentCount,
+            emergency=self.emergencyAction.stats(),
+            watchdog=self.staleWatchdog.stats(),
+            live=self.livePublisher.snapshot(),
+            autoReport=self.autoReport.stats(),
+            startup=dict(
+                importSeconds=IMPORT_SECONDS,
+                initSeconds=self.initSeconds
+            ),
+            history=dict(
+                enabled=self.engine.recorder is not None,
+                written=self.historyStore.written,
+                dropped=self.historyStore.dropped,
+                failed=self.historyStore.failed
+            ),
+            sharedState=self.shared_state_status(),
+            hooks=self.hookDispatcher.stats()
+        )
+
+    # Function to start or stop storing the history, and to pass on the file limits
+    def apply_history_settings(self, settings):
+        store = self.historyStore
+        store.maxFileSize = int(settings.historyFileSize * 1024 * 1024)
+        store.maxFiles = max(1, settings.historyFiles)
+        if settings.historyEnabled:
+            try:
+                store.start()
+            except (OSError, IOError) as e:
+                self.logger.error('Couldn\'t create the history folder %s, the history won\'t be kept: %s',
+                                  store.folder, e)
+                self.engine.recorder = None
+                return
+            self.engine.recorder = store.record_heater
+        elif self.engine.recorder is not None:
+            self.engine.recorder = None
+            store.stop()
+
+    # Function to start or stop the stale report watchdog, and to pass on the timeout
+    def apply_watchdog_settings(self, settings):
+        self.staleWatchdog.timeout = settings.staleTimeout
+        if settings.staleDetection:
+            self.staleWatchdog.start()
+            self.staleWatchdog.wake()
+        else:
+            self.staleWatchdog.stop()
+
+    # Function to describe the shared state, if it is being published
+    def shared_state_status(self):
+        statePublisher = self.statePublisher
+        if statePublisher is None:
+            return dict(enabled=False, path=None, writes=0)
+        return dict(enabled=True, path=statePublisher.path, writes=statePublisher.writes)
+
+    # Function to start or stop publishing the shared state for the companion watchdog, a new path starts a new file
+    def apply_shared_state_settings(self, settings):
+        path = settings.sharedStatePath or default_shared_state_path()
+        statePublisher = self.statePublisher
+        if statePublisher is not None and (not settings.sharedState or statePublisher.path != path):
+            self.statePublisher = None
+            statePublisher.stop()
+            self.logger.info('Stopped publishing the shared state to %s', statePublisher.path)
+        if settings.sharedState and self.statePublisher is None:
+            statePublisher = StatePublisher(path, self.logger)
+            try:
+                statePublisher.start()
+            except (OSError, IOError) as e:
+                self.logger.error('Couldn\'t create the shared state at %s, the companion watchdog won\'t be able to '
+                                  'watch the heaters: %s', path, e)
+                return
+            # Publish what we already know, so the companion doesn't have to wait for the next report. Anything from
+            # before the printer was last disconnected is published without being armed
+            statePublisher.disarmedAt = self.staleWatchdog.disarmedAt
+            statePublisher.publish(self.engine.heaters)
+            self.statePublisher = statePublisher
+            self.logger.info('Publishing the shared state to %s', path)
+
+    # Function to read the stored history of a heater for the last `minutes` minutes, one list per column
+    def get_history(self, heater, minutes):
+        since = time.time() - minutes * 60
+        records = self.historyStore.read(heater, since)
+        return dict(
+            heater=heater,
+            since=since,
+            times=[record[0] for record in records],
+            current=[round(record[1], 2) for record in records],
+            set=[round(record[2], 2) for record in records],
+            state=[record[3] for record in records]
+        )
+
+    # Function that is used to call all plugins that have registered handlers for this plugins hooks
+    def runaway_triggered(self, heater_id: str, set_temp: float, current_temp: float, runaway_type: str):
+        # Time that the runaway was caught, used to measure how long it takes to get the emergency GCode out
+        detected = time.perf_counter()
+        # Wrap everything in a try-except to catch any errors
+        try:
+            # Send the emergency GCode, ahead of anything queued, and then turn the heaters off if the user wants
+            heaters = [heater.name for heater in self.engine.heaters] if self.settingsSnapshot.disableHeaters else ()
+            self.emergencyAction.fire(detected, self.emergencyGCode, heaters)
+
+            # Call every plugin that has registered a handler to cut the power, then every plugin that has registered
+            # a handler for the hook runaway_triggered, and then the handlers for over_runaway_triggered or
+            # under_runaway_triggered. The handlers run on a shared pool of threads so that a slow handler can't hold
+            # up the others
+            args = (heater_id, set_temp, current_temp)
+            self.hookDispatcher.dispatch("octoprint.plugin.ThermalRunaway.power_off", args)
+            self.hookDispatcher.dispatch("octoprint.plugin.ThermalRunaway.runaway_triggered", args)
+
+            if runaway_type == 'over':
+                self.hookDispatcher.dispatch("octoprint.plugin.ThermalRunaway.over_runaway_triggered", args)
+
+            if runaway_type == 'under':
+                self.hookDispatcher.dispatch("octoprint.plugin.ThermalRunaway.under_runaway_triggered", args)
+
+        except Exception as e:
+            # Log that something went wrong
+            self.logger.exception("Exception in runaway_triggered: {}".format(e))
+        finally:
+            return
+
+    # Function called by the watchdog when a heater that is turned on hasn't been reported for too long. Depending on
+    # the staleAction setting this only warns (warn), turns the heaters off (heatersOff), or sends the emergency GCode
+    # and calls the power off handlers as for a thermal runaway (emergency)
+    def reports_stale(self, heater, age):
+        detected = time.perf_counter()
+        try:
+            settings = self.settingsSnapshot
+            self.logger.critical('No temperature report for heater {h} in {a:.0f} seconds while it is set to {s}, '
+                                 'last reported temp was {c} ({action})'.format(h=heater.name, a=age, s=heater.set,
+                                                                                c=heater.current,
+                                                                                action=settings.staleAction))
+            heaters = [h.name for h in self.engine.heaters]
+            if settings.staleAction == 'emergency':
+                self.emergencyAction.fire(detected, self.emergencyGCode, heaters if settings.disableHeaters else ())
+                self.hookDispatcher.dispatch("octoprint.plugin.ThermalRunaway.power_off",
+                                             (heater.name, heater.set, heater.current))
+            elif settings.staleAction == 'heatersOff':
+                self.emergencyAction.heaters_off(heaters)
+
+            # Call every plugin that has registered a handler for the hook reports_stale
+            self.hookDispatcher.dispatch("octoprint.plugin.ThermalRunaway.reports_stale",
+                                         (heater.name, heater.set, heater.current))
+        except Exception as e:
+            # Log that something went wrong
+            self.logger.exception("Exception in reports_stale: {}".format(e))
+
+    ########################
+    # Software Update Hook #
+    ########################
+    # Function to tell OctoPrint how to update the plugin
+    def get_update_information(self):
+        # Define the configuration for your plugin to use with the Software Update
+        # Plugin here. See https://docs.octoprint.org/en/master/bundledplugins/softwareupdate.html
+        # for details.
+        return dict(
+            ThermalRunaway=dict(
+                displayName="Thermal Runaway Plugin",
+                displayVersion=self._plugin_version,
+
+                # version check: github repository
+                type="github_release",
+                user="AlexVerrico",
+                repo="Octoprint-ThermalRunaway",
+                current=self._plugin_version,
+
+                # update method: pip
+                pip="https://github.com/AlexVerrico/Octoprint-ThermalRunaway/archive/{target_version}.zip"
+            )
+        )
@@ -0,0 +1,152 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+# Replays the temperature reports in an OctoPrint serial.log through the same engine the plugin uses, to see what
+# a set of settings would have made of past prints: which heaters would have been warned about, and which would have
+# been caught as a thermal runaway.
+#
+# Run with:
+#     thermalrunaway-replay serial.log [--set tMaxDiff=15 --set tDelay=30 ...] [--json] [--verbose]
+# or, without installing the plugin:
+#     python -m octoprint_ThermalRunaway.replay serial.log ...
+
+import argparse
+import collections
+import json
+import logging
+import time
+
+from .engine import MonitorEngine
+from .serial_log import read_reports
+from .settings import SETTINGS_DEFAULTS, build_snapshot_from_dict
+
+
+# Turn the --set arguments into settings overrides, raises ValueError for anything that isn't a setting
+def parse_overrides(assignments):
+    overrides = {}
+    for assignment in assignments or []:
+        key, separator, value = assignment.partition('=')
+        if not separator or key not in SETTINGS_DEFAULTS:
+            raise ValueError('{} is not a setting, expected one of {}'.format(
+                assignment, ', '.join(sorted(SETTINGS_DEFAULTS))))
+        if isinstance(SETTINGS_DEFAULTS[key], bool):
+            value = value.lower() in ('1', 'true', 'yes', 'on')
+        overrides[key] = value
+    return overrides
+
+
+# Replay a serial.log through a MonitorEngine and return a summary of what it caught
+def replay_log(path, overrides=None, logger=None, blockSize=65536, parseOnly=False):
+    logger = logger if logger is not None else logging.getLogger('octoprint.plugins.ThermalRunaway.replay')
+    runaways = []
+    warnings = collections.OrderedDict()  # (heater, low/high/rate/stall/model) -> times the warning started
+
+    def on_warning(heater, kind, receivedAt):
+        warnings.setdefault((heater, kind), []).append(receivedAt)
+
+    engine = MonitorEngine(build_snapshot_from_dict(overrides), logger, on_warning=on_warning)
+
+    # offset is the log offset of the report being replayed when the runaway is caught
+    def on_runaway(heater, setTemp, currentTemp, runawayType):
+        runaways.append(dict(engine.heaterIndex[heater].incident, offset=offset))
+
+    engine.on_runaway = on_runaway
+
+    reports = 0
+    first = last = None
+    heaters = []
+    parseTime = replayTime = 0.0
+    blocks = read_reports(path, blockSize)
+    while True:
+        started = time.perf_counter()
+        block = next(blocks, None)
+        parseTime += time.perf_counter() - started
+        if block is None:
+            break
+
+        reports += len(block)
+        heaters = block.heaters
+        first = block.times[0] if first is None else first
+        last = block.times[-1]
+        if parseOnly:
+            continue
+
+        started = time.perf_counter()
+        for receivedAt, offset, temps in block.rows():
+            engine.evaluate(temps)
+        replayTime += time.perf_counter() - started
+
+    return dict(
+        log=path,
+        reports=reports,
+        heaters=list(heaters),
+        start=first,
+        end=last,
+        parseSeconds=parseTime,
+        replaySeconds=replayTime,
+        warnings=[dict(heater=heater, kind=kind, count=len(times), first=times[0])
+                  for (heater, kind), times in warnings.items()],
+        runaways=runaways
+    )
+
+
+def _format_time(seconds):
+    if seconds is None:
+        return '-'
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(seconds)) + ',{:03d}'.format(int(seconds % 1 * 1000))
+
+
+def print_summary(summary):
+    print('{}: {} reports from {} to {}, heaters {}'.format(summary['log'], summary['reports'],
+                                                           _format_time(summary['start']),
+                                                           _format_time(summary['end']),
+                                                           ', '.join(summary['heaters']) or 'none'))
+    print('parsed in {:.2f} s, replayed in {:.2f} s'.format(summary['parseSeconds'], summary['replaySeconds']))
+
+    print('\nwarnings:')
+    for warning in summary['warnings']:
+        print('  {:<4} {:<6} {:>6} times, first at {}'.format(warning['heater'], warning['kind'], warning['count'],
+                                                             _format_time(warning['first'])))
+    if not summary['warnings']:
+        print('  none')
+
+    print('\nrunaways:')
+    for runaway in summary['runaways']:
+        print('  {}  {:<4} {:<5} ({}), set {}, current {}, log offset {}'.format(
+            _format_time(runaway['tripped']), runaway['heater'], runaway['type'], runaway['reason'],
+            runaway['set'], runaway['current'], runaway['offset']))
+    if not summary['runaways']:
+        print('  none')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay the temperature reports in an OctoPrint serial.log through "
+                                                 "the Thermal Runaway checks")
+    parser.add_argument("log", help="path to serial.log")
+    parser.add_argument("--set", action="append", metavar="SETTING=VALUE", dest="overrides",
+                        help="override a plugin setting, eg. --set tMaxDiff=15. Can be given more than once")
+    parser.add_argument("--block-size", type=int, default=65536, help="reports parsed at a time")
+    parser.add_argument("--parse-only", action="store_true", help="only parse the log, don't replay it")
+    parser.add_argument("--json", action="store_true", help="print the summary as JSON")
+    parser.add_argument("--verbose", action="store_true", help="show the engine's warning log messages")
+    args = parser.parse_args(argv)
+
+    try:
+        overrides = parse_overrides(args.overrides)
+    except ValueError as e:
+        parser.error(str(e))
+
+    logging.basicConfig(format='%(message)s')
+    logger = logging.getLogger('octoprint.plugins.ThermalRunaway.replay')
+    logger.setLevel(logging.WARNING if args.verbose else logging.CRITICAL + 1)
+
+    summary = replay_log(args.log, overrides, logger, args.block_size, args.parse_only)
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        print_summary(summary)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,139 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+# Reads the temperature reports out of OctoPrint's serial.log. The log is memory mapped and scanned with a compiled
+# pattern, so only the reports are ever turned into Python objects, and they are handed back in fixed size blocks of
+# columns so that memory use doesn't grow with the size of the log.
+#
+# serial.log lines look like:
+#     2023-05-01 12:00:00,123 - Recv: ok T:210.0 /210.0 B:60.0 /60.0 @:127 B@:0
+#     2023-05-01 12:00:01,124 - Recv:  T:210.1 /210.0 B:60.0 /60.0 @:127 B@:0
+
+# Import array. Each column is a flat array of doubles
+from array import array
+# Import mmap. The log is mapped rather than read, so the OS pages it in and out as it is scanned
+import mmap
+# Import re. Both patterns are compiled once
+import re
+# Import time. Used to turn the log timestamps into seconds
+import time
+
+from .parsing import TEMPERATURE_PATTERN, build_report
+
+# A received line that starts with a heater, optionally after "ok". The pattern starts with plain text so that the
+# scan can skip straight to each received line, the timestamp at the start of the line is matched separately
+REPORT_PATTERN = re.compile(br' - Recv: (?:ok)? *([TBC]\d*:[^\r\n]*)')
+TIMESTAMP_PATTERN = re.compile(br'(\d{4}-\d\d-\d\d) (\d\d):(\d\d):(\d\d),(\d{3})')
+# The same pattern parse_temperature_line uses, for the bytes in the log
+HEATER_PATTERN = re.compile(TEMPERATURE_PATTERN.pattern.encode('ascii'))
+
+NAN = float('NaN')
+
+# Maximum number of distinct report texts remembered by the parser. Printers report the same temperatures over and
+# over while they hold them, so most reports can be looked up rather than parsed
+PARSE_CACHE_SIZE = 4096
+
+
+class ReportColumns(object):
+    # A block of reports stored column by column: the time of each report and the offset of its line in the log, and
+    # for each heater an array of current temps and one of set temps, NaN wherever the heater wasn't reported
+    __slots__ = ('times', 'offsets', 'heaters', 'currents', 'sets')
+
+    def __init__(self, heaters=()):
+        self.times = array('d')
+        self.offsets = array('q')
+        self.heaters = []
+        self.currents = {}
+        self.sets = {}
+        for name in heaters:
+            self.add_heater(name)
+
+    def __len__(self):
+        return len(self.times)
+
+    # Add a column for a heater, NaN for every report already in the block
+    def add_heater(self, name):
+        self.heaters.append(name)
+        self.currents[name] = array('d', [NAN]) * len(self.times)
+        self.sets[name] = array('d', [NAN]) * len(self.times)
+
+    # Add a report, temps is keyed by heater with (current, set) values
+    def append(self, receivedAt, offset, temps):
+        currents = self.currents
+        sets = self.sets
+        for name in temps:
+            if name not in currents:
+                self.add_heater(name)
+        self.times.append(receivedAt)
+        self.offsets.append(offset)
+        for name in self.heaters:
+            values = temps.get(name)
+            if values is None:
+                currents[name].append(NAN)
+                sets[name].append(NAN)
+            else:
+                currents[name].append(values[0])
+                sets[name].append(NAN if values[1] is None else values[1])
+
+    # The reports as (time, offset, temps) where temps is keyed by heater with (current, set, time) values, the way
+    # MonitorEngine.evaluate takes them
+    def rows(self):
+        columns = [(name, self.currents[name], self.sets[name]) for name in self.heaters]
+        for index, receivedAt in enumerate(self.times):
+            temps = {}
+            for name, currents, sets in columns:
+                current = currents[index]
+                if current == current:
+                    setTemp = sets[index]
+                    temps[name] = (current, setTemp if setTemp == setTemp else None, receivedAt)
+            yield receivedAt, self.offsets[index], temps
+
+
+# Read the temperature reports from a serial.log, yielding ReportColumns of up to blockSize reports each. Every block
+# has a column for every heater seen so far, in the order they were first seen
+def read_reports(path, blockSize=65536):
+    with open(path, 'rb') as logFile:
+        try:
+            log = mmap.mmap(logFile.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty file, nothing to map
+            return
+        if hasattr(log, 'madvise'):
+            # Let the OS know the log is read front to back, so it can read ahead and drop pages already scanned
+            log.madvise(mmap.MADV_SEQUENTIAL)
+        try:
+            days = {}  # date -> seconds since the epoch at midnight
+            cache = {}  # report text -> parsed temps
+            block = ReportColumns()
+            matches = REPORT_PATTERN.finditer(log)
+            for match in matches:
+                lineStart = log.rfind(b'\n', 0, match.start()) + 1
+                stamp = TIMESTAMP_PATTERN.match(log, lineStart)
+                if stamp is None:
+                    continue
+                date, hours, minutes, seconds, millis = stamp.groups()
+                text = match.group(1)
+                day = days.get(date)
+                if day is None:
+                    day = days[date] = time.mktime(time.strptime(date.decode('ascii'), '%Y-%m-%d'))
+
+                temps = cache.get(text)
+                if temps is None:
+                    if len(cache) >= PARSE_CACHE_SIZE:
+                        cache.clear()
+                    temps = cache[text] = build_report((heater.decode('ascii'), current, target)
+                                                        for heater, current, target in HEATER_PATTERN.findall(text))
+                if not temps:
+                    continue
+
+                block.append(day + int(hours) * 3600 + int(minutes) * 60 + int(seconds) + int(millis) / 1000.0,
+                             lineStart, temps)
+                if len(block) >= blockSize:
+                    yield block
+                    block = ReportColumns(block.heaters)
+            if len(block):
+                yield block
+        finally:
+            # The map can't be closed while the scanner still has hold of it
+            matches = match = stamp = None
+            log.close()
@@ -0,0 +1,170 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+# Import namedtuple. Snapshots are immutable so the evaluator can never see a half updated set of settings
+from collections import namedtuple
+# Import logging. Used to warn about settings that can't be parsed
+import logging
+# Import math. Used to reject settings that parse to NaN or infinity
+import math
+
+
+# Default values for every setting, as stored by OctoPrint
+SETTINGS_DEFAULTS = dict(
+    emergencyGcode="M112",
+    disableHeaters=True,
+    bMaxDiff="10",
+    bMaxOffTemp="30",
+    tMaxDiff="20",
+    tMaxOffTemp="30",
+    tDelay="25",
+    bDelay="20",
+    cMaxDiff="10",
+    cMaxOffTemp="50",
+    cDelay="60",
+    chamberMonitoring=False,
+    bRateWindow="30",
+    bMaxRiseRate="0.2",
+    bMinHeatRate="0.02",
+    tRateWindow="10",
+    tMaxRiseRate="0.5",
+    tMinHeatRate="0.1",
+    cRateWindow="60",
+    cMaxRiseRate="0.1",
+    cMinHeatRate="0",
+    rateDetection=True,
+    rateConfirm="3",
+    predictiveDetection=False,
+    predictionHorizon="10",
+    triggerOnEqual=True,
+    warningLogInterval="10",
+    tripCooldown="0",
+    hookTimeout="10",
+    historyEnabled=True,
+    historyFileSize="4",
+    historyFiles="4",
+    staleDetection=True,
+    staleTimeout="60",
+    staleAction="warn",
+    liveInterval="2",
+    adaptiveAutoReport=True,
+    autoReportFast="1",
+    sharedState=False,
+    sharedStatePath=""
+)
+
+# Thresholds for one class of heater (bed, hotend or chamber), already converted to floats
+HeaterSettings = namedtuple('HeaterSettings', ['delay', 'maxDiff', 'maxOffTemp',
+                                               'rateWindow', 'maxRiseRate', 'minHeatRate'])
+
+# Everything the evaluator needs from the plugin settings
+SettingsSnapshot = namedtuple('SettingsSnapshot', ['emergencyGcode', 'disableHeaters', 'triggerOnEqual',
+                                                   'warningLogInterval', 'tripCooldown', 'hookTimeout',
+                                                   'rateDetection', 'rateConfirm',
+                                                   'predictiveDetection', 'predictionHorizon',
+                                                   'historyEnabled', 'historyFileSize', 'historyFiles',
+                                                   'staleDetection', 'staleTimeout', 'staleAction', 'liveInterval',
+                                                   'adaptiveAutoReport', 'autoReportFast',
+                                                   'sharedState', 'sharedStatePath', 'chamberMonitoring',
+                                                   'bed', 'tool', 'chamber'])
+
+
+# Work out which class of heater a key from OctoPrint's parsed temps belongs to, returns None for anything that we
+# don't know how to monitor
+def heater_class(name):
+    if name == 'B':
+        return 'bed'
+    if name == 'C':
+        return 'chamber'
+    if name[:1] == 'T' and name[1:].isdigit():
+        return 'tool'
+    return None
+
+
+# Function to read a number setting, falling back to its default (and logging a warning) if the value saved can't be
+# parsed, so that one bad value can't stop the plugin from starting
+def read_float(settings, key, logger):
+    value = settings.get([key])
+    try:
+        parsed = float(value)
+        if not math.isnan(parsed) and not math.isinf(parsed):
+            return parsed
+    except (TypeError, ValueError):
+        pass
+    logger.warning('Setting %s is %r, which isn\'t a number, using the default of %s instead', key, value,
+                   SETTINGS_DEFAULTS[key])
+    return float(SETTINGS_DEFAULTS[key])
+
+
+# Function to read a whole number setting, falling back to its default in the same way as read_float
+def read_int(settings, key, logger):
+    value = settings.get([key])
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        logger.warning('Setting %s is %r, which isn\'t a whole number, using the default of %s instead', key, value,
+                       SETTINGS_DEFAULTS[key])
+        return int(SETTINGS_DEFAULTS[key])
+
+
+# Function to read the thresholds for one class of heater, prefix is b, t or c
+def build_heater_settings(settings, prefix, logger):
+    return HeaterSettings(
+        delay=read_float(settings, prefix + 'Delay', logger),
+        maxDiff=read_float(settings, prefix + 'MaxDiff', logger),
+        maxOffTemp=read_float(settings, prefix + 'MaxOffTemp', logger),
+        rateWindow=read_float(settings, prefix + 'RateWindow', logger),
+        maxRiseRate=read_float(settings, prefix + 'MaxRiseRate', logger),
+        minHeatRate=read_float(settings, prefix + 'MinHeatRate', logger)
+    )
+
+
+# Function to read the plugin settings once and parse them into a SettingsSnapshot. Any number that can't be parsed
+# is replaced by its default, with a warning logged to logger
+def build_snapshot(settings, logger=None):
+    logger = logger if logger is not None else logging.getLogger('octoprint.plugins.ThermalRunaway')
+    return SettingsSnapshot(
+        emergencyGcode=settings.get(['emergencyGcode']),
+        disableHeaters=bool(settings.get(['disableHeaters'])),
+        triggerOnEqual=bool(settings.get(['triggerOnEqual'])),
+        warningLogInterval=read_float(settings, 'warningLogInterval', logger),
+        tripCooldown=read_float(settings, 'tripCooldown', logger),
+        # The hook watcher sleeps for up to this long between checks, so it has to be a real amount of time
+        hookTimeout=max(1.0, read_float(settings, 'hookTimeout', logger)),
+        rateDetection=bool(settings.get(['rateDetection'])),
+        rateConfirm=read_float(settings, 'rateConfirm', logger),
+        predictiveDetection=bool(settings.get(['predictiveDetection'])),
+        predictionHorizon=read_float(settings, 'predictionHorizon', logger),
+        historyEnabled=bool(settings.get(['historyEnabled'])),
+        historyFileSize=read_float(settings, 'historyFileSize', logger),
+        historyFiles=read_int(settings, 'historyFiles', logger),
+        staleDetection=bool(settings.get(['staleDetection'])),
+        staleTimeout=read_float(settings, 'staleTimeout', logger),
+        staleAction=settings.get(['staleAction']),
+        liveInterval=read_float(settings, 'liveInterval', logger),
+        adaptiveAutoReport=bool(settings.get(['adaptiveAutoReport'])),
+        # M155 takes whole seconds and S0 turns the reports off, so never ask for less than 1
+        autoReportFast=max(1, int(round(read_float(settings, 'autoReportFast', logger)))),
+        sharedState=bool(settings.get(['sharedState'])),
+        sharedStatePath=settings.get(['sharedStatePath']),
+        chamberMonitoring=bool(settings.get(['chamberMonitoring'])),
+        bed=build_heater_settings(settings, 'b', logger),
+        tool=build_heater_settings(settings, 't', logger),
+        chamber=build_heater_settings(settings, 'c', logger)
+    )
+
+
+class _DictSettings(object):
+    # Reads settings from a plain dict, for running the engine outside of OctoPrint
+    def __init__(self, values):
+        self.values = values
+
+    def get(self, path):
+        return self.values[path[0]]
+
+
+# Function to build a SettingsSnapshot from the defaults, with any values in overrides replacing them
+def build_snapshot_from_dict(overrides=None):
+    values = dict(SETTINGS_DEFAULTS)
+    values.update(overrides or {})
+    return build_snapshot(_DictSettings(values))
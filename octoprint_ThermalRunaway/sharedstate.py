@@ -0,0 +1,286 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+# State of every heater published to a small memory mapped file, so that a watchdog in another process (see
+# companion.py) can keep checking the heaters, and notice if OctoPrint's Python process stops running, without
+# depending on that process being healthy.
+#
+# Layout, little endian:
+#     0   prefix:  magic b'TRSS', version, record size, max heaters, 2 pad bytes, pid of the publisher
+#     16  seq:     uint64, odd while a write is in progress
+#     24  body:    published (double, time of the last report), heartbeat (double, time the publisher last
+#                  showed it was alive), count (uint32), flags (uint32, FLAG_ARMED while the records are from the
+#                  printer that is connected now), crc32 of the body and records with crc left out (uint32)
+#     52  records: count records of name (8 bytes, NUL padded), received, current, set (doubles), state flags
+#                  (see store.py), 7 pad bytes
+#
+# Reads use the seq as a seqlock: read seq, copy the body and records, read seq again, and retry if it was odd or
+# has changed. The crc catches anything the seqlock can't on its own, such as the writes being seen out of order on
+# a CPU with weak memory ordering, so a torn read is never returned.
+
+# Import mmap. The state is shared through a memory mapped file
+import mmap
+# Import os. Used to create the file
+import os
+# Import struct. Everything is in a fixed binary layout
+import struct
+# Import tempfile. Used to find somewhere to put the file where there is no /dev/shm
+import tempfile
+# Import threading. Used for the heartbeat thread, and to keep the heartbeat and the evaluator from writing at once
+import threading
+# Import time. Used for the heartbeat
+import time
+# Import zlib. Used for the crc
+import zlib
+
+from .store import heater_state
+
+MAGIC = b'TRSS'
+VERSION = 2
+MAX_HEATERS = 16
+
+# Set in the flags while the records are from reports received since the printer connected. Cleared when the printer
+# is disconnected, the records are then only what the heaters were doing before that and aren't checked
+FLAG_ARMED = 1
+
+PREFIX = struct.Struct('<4sHHH2xI')
+SEQ = struct.Struct('<Q')
+SEQ_OFFSET = PREFIX.size
+BODY = struct.Struct('<ddII')
+CRC = struct.Struct('<I')
+BODY_OFFSET = SEQ_OFFSET + SEQ.size
+RECORDS_OFFSET = BODY_OFFSET + BODY.size + CRC.size
+RECORD = struct.Struct('<8sdddB7x')
+
+
+# Where to put the file if no path is given: /dev/shm where there is one, so that it never touches the SD card of a
+# Raspberry Pi, otherwise the temp folder
+def default_path():
+    folder = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(folder, 'octoprint-thermalrunaway.state')
+
+
+def _size(maxHeaters):
+    return RECORDS_OFFSET + maxHeaters * RECORD.size
+
+
+class HeaterSnapshot(object):
+    # One heater as read from the shared state
+    __slots__ = ('name', 'received', 'current', 'set', 'state')
+
+    def __init__(self, name, received, current, setTemp, state):
+        self.name = name
+        self.received = received
+        self.current = current
+        self.set = setTemp
+        self.state = state
+
+
+class SharedState(object):
+    # A consistent copy of the shared state
+    __slots__ = ('seq', 'pid', 'published', 'heartbeat', 'armed', 'heaters')
+
+    def __init__(self, seq, pid, published, heartbeat, armed, heaters):
+        self.seq = seq
+        self.pid = pid
+        self.published = published
+        self.heartbeat = heartbeat
+        self.armed = armed
+        self.heaters = heaters
+
+
+class StatePublisher(object):
+    # Writes the state of the heaters to the shared file after each report, and a heartbeat every heartbeatInterval
+    # seconds from its own thread. The heartbeat stops when the interpreter does, which is what the companion watchdog
+    # looks for
+    def __init__(self, path, logger, maxHeaters=MAX_HEATERS, heartbeatInterval=1.0):
+        self.path = path
+        self.logger = logger
+        self.maxHeaters = maxHeaters
+        self.heartbeatInterval = heartbeatInterval
+
+        self._lock = threading.Lock()
+        self._mapped = None
+        self._file = None
+        self._seq = 0
+        self._published = 0.0
+        self._records = b''
+        self._count = 0
+        self._flags = 0
+        # Reports received before this time are from before the printer was disconnected
+        self.disarmedAt = 0.0
+        self._wake = threading.Event()
+        self._running = False
+        self._thread = None
+
+        # Counters
+        self.writes = 0
+
+    # Create the file and start the heartbeat thread, does nothing if it is already running
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._mapped is None:
+                self._open()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="ThermalRunaway shared state")
+        self._thread.daemon = True
+        self._thread.start()
+
+    # Stop the heartbeat thread and remove the file, so that the companion doesn't take it for a stall
+    def stop(self, timeout=2.0):
+        self._running = False
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        with self._lock:
+            if self._mapped is not None:
+                self._mapped.close()
+                self._file.close()
+                self._mapped = self._file = None
+                try:
+                    os.remove(self.path)
+                except OSError:
+                    pass
+
+    def _open(self):
+        size = _size(self.maxHeaters)
+        # Write the whole file at once, a reader that opens it part way through sees a bad magic rather than a
+        # half written prefix
+        temporary = self.path + '.new'
+        with open(temporary, 'wb') as stateFile:
+            stateFile.write(PREFIX.pack(MAGIC, VERSION, RECORD.size, self.maxHeaters, os.getpid()))
+            stateFile.write(b'\0' * (size - PREFIX.size))
+        os.rename(temporary, self.path)
+        self._file = open(self.path, 'r+b')
+        self._mapped = mmap.mmap(self._file.fileno(), size)
+        self._seq = 0
+
+    # Publish the state of the heaters, called from the evaluator after each report
+    def publish(self, heaters):
+        pack = RECORD.pack
+        records = []
+        published = 0.0
+        for heater in heaters[:self.maxHeaters]:
+            records.append(pack(heater.name.encode('ascii', 'replace')[:8], heater.received, heater.current,
+                                heater.set, heater_state(heater)))
+            if heater.received > published:
+                published = heater.received
+        with self._lock:
+            self._published = published
+            self._records = b''.join(records)
+            self._count = len(records)
+            self._flags = FLAG_ARMED if published >= self.disarmedAt else 0
+            self._write(time.time())
+
+    # Say that the printer has been disconnected, at is when (the time the plugin's stale report watchdog was
+    # disarmed). The heaters stay in the file but aren't armed, so the companion doesn't take the reports stopping
+    # for a stall, until a report received after that is published
+    def disarm(self, at=None):
+        with self._lock:
+            self.disarmedAt = time.time() if at is None else at
+            if self._published < self.disarmedAt:
+                self._flags = 0
+            self._write(time.time())
+
+    # Write the last state published with a new heartbeat. Always called with the lock held
+    def _write(self, heartbeat):
+        mapped = self._mapped
+        if mapped is None:
+            return
+        body = BODY.pack(self._published, heartbeat, self._count, self._flags)
+        crc = zlib.crc32(body + self._records) & 0xffffffff
+        data = body + CRC.pack(crc) + self._records
+
+        seq = self._seq + 1
+        SEQ.pack_into(mapped, SEQ_OFFSET, seq)
+        mapped[BODY_OFFSET:BODY_OFFSET + len(data)] = data
+        SEQ.pack_into(mapped, SEQ_OFFSET, seq + 1)
+        self._seq = seq + 1
+        self.writes += 1
+
+    def _run(self):
+        while self._running:
+            try:
+                with self._lock:
+                    self._write(time.time())
+            except Exception as e:
+                self.logger.exception("Exception while writing the shared state heartbeat: {}".format(e))
+            self._wake.wait(self.heartbeatInterval)
+
+
+class StateReader(object):
+    # Reads the shared state written by a StatePublisher, from any process
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._mapped = None
+        self._inode = None
+
+        # Counters
+        self.reads = 0
+        self.retries = 0  # Reads that had to be tried again because they overlapped a write
+
+    # Map the file, or map it again if the publisher has started a new one. Returns False if there isn't a usable one
+    def _open(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            self.close()
+            return False
+        if self._mapped is not None and stat.st_ino == self._inode:
+            return True
+        self.close()
+        try:
+            stateFile = open(self.path, 'rb')
+            mapped = mmap.mmap(stateFile.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return False
+        if len(mapped) < RECORDS_OFFSET or PREFIX.unpack_from(mapped, 0)[:3] != (MAGIC, VERSION, RECORD.size):
+            mapped.close()
+            stateFile.close()
+            return False
+        self._file, self._mapped, self._inode = stateFile, mapped, stat.st_ino
+        return True
+
+    def close(self):
+        if self._mapped is not None:
+            self._mapped.close()
+            self._file.close()
+        self._file = self._mapped = self._inode = None
+
+    # Read a consistent copy of the state, returns None if there isn't one or it couldn't be read without tearing
+    def read(self, attempts=100):
+        if not self._open():
+            return None
+        mapped = self._mapped
+        magic, version, recordSize, maxHeaters, pid = PREFIX.unpack_from(mapped, 0)
+        end = BODY_OFFSET + BODY.size + CRC.size + maxHeaters * recordSize
+        for attempt in range(0, attempts):
+            before = SEQ.unpack_from(mapped, SEQ_OFFSET)[0]
+            if before & 1:
+                self.retries += 1
+                time.sleep(0)
+                continue
+            data = mapped[BODY_OFFSET:end]
+            if SEQ.unpack_from(mapped, SEQ_OFFSET)[0] != before:
+                self.retries += 1
+                continue
+
+            published, heartbeat, count, flags = BODY.unpack_from(data, 0)
+            count = min(count, maxHeaters)
+            records = data[BODY.size + CRC.size:BODY.size + CRC.size + count * recordSize]
+            if CRC.unpack_from(data, BODY.size)[0] != zlib.crc32(data[:BODY.size] + records) & 0xffffffff:
+                self.retries += 1
+                continue
+
+            heaters = []
+            for offset in range(0, len(records), recordSize):
+                name, received, current, setTemp, state = RECORD.unpack_from(records, offset)
+                heaters.append(HeaterSnapshot(name.rstrip(b'\0').decode('ascii', 'replace'), received, current,
+                                              setTemp, state))
+            self.reads += 1
+            return SharedState(before, pid, published, heartbeat, bool(flags & FLAG_ARMED), heaters)
+        return None
@@ -0,0 +1,203 @@
+/*
+ * View model for the Thermal Runaway sidebar panel
+ *
+ * Starts from the full state of the heaters in the status API, then applies the live updates that the plugin sends
+ * over the socket. Each update only holds the fields that have changed, see live.py for the format. If an update is
+ * missed (there's a gap in seq), or the socket reconnects, the full state is fetched again.
+ *
+ * A heater caught as a Thermal Runaway stays latched, and isn't checked, until it is reset. Users allowed to control
+ * the printer get a button to reset it from here.
+ */
+$(function() {
+    function HeaterRow(name) {
+        var self = this;
+        self.name = name;
+        self.current = ko.observable(null);
+        self.set = ko.observable(null);
+        self.min = ko.observable(null);
+        self.max = ko.observable(null);
+        self.state = ko.observable("off");
+        self.tripAt = ko.observable(null);
+    }
+
+    function ThermalRunawayViewModel(parameters) {
+        var self = this;
+
+        self.loginState = parameters[0];
+        self.access = parameters[1];
+
+        self.heaters = ko.observableArray([]);
+        self.rows = {};
+        self.seq = null; // seq of the last update applied, null until the full state has been fetched
+        self.fetching = false;
+        self.pending = []; // Updates received while the full state is being fetched
+
+        // Difference between the plugin's clock and ours in seconds, and our clock ticking once a second, used for
+        // the countdowns
+        self.offset = 0;
+        self.now = ko.observable(Date.now() / 1000);
+
+        self.row = function(name) {
+            var row = self.rows[name];
+            if (row === undefined) {
+                row = self.rows[name] = new HeaterRow(name);
+                self.heaters.push(row);
+                self.heaters.sort(function(a, b) {
+                    return a.name < b.name ? -1 : a.name > b.name ? 1 : 0;
+                });
+            }
+            return row;
+        };
+
+        self.applyFields = function(name, fields) {
+            var row = self.row(name);
+            _.each(fields, function(value, key) {
+                if (ko.isObservable(row[key])) {
+                    row[key](value);
+                }
+            });
+        };
+
+        self.apply = function(update) {
+            if (update.seq <= self.seq) {
+                // Already included in the full state
+                return;
+            }
+            if (update.seq !== self.seq + 1) {
+                // Missed an update
+                self.requestData();
+                return;
+            }
+            self.seq = update.seq;
+            self.offset = update.time - Date.now() / 1000;
+            _.each(update.heaters, function(fields, name) {
+                self.applyFields(name, fields);
+            });
+        };
+
+        self.requestData = function() {
+            if (self.fetching || !self.loginState.isUser()) {
+                return;
+            }
+            self.fetching = true;
+            self.seq = null;
+            OctoPrint.simpleApiGet("ThermalRunaway")
+                .done(function(status) {
+                    var live = status.live;
+                    self.seq = live.seq;
+                    if (live.time !== null) {
+                        self.offset = live.time - Date.now() / 1000;
+                    }
+                    _.each(live.heaters, function(fields, name) {
+                        self.applyFields(name, fields);
+                    });
+                    var pending = self.pending;
+                    self.pending = [];
+                    _.each(pending, self.apply);
+                })
+                .fail(function() {
+                    // Start again from the next update
+                    self.pending = [];
+                })
+                .always(function() {
+                    self.fetching = false;
+                });
+        };
+
+        self.onDataUpdaterPluginMessage = function(plugin, data) {
+            if (plugin !== "ThermalRunaway" || data.type !== "heaters") {
+                return;
+            }
+            if (self.seq === null) {
+                self.pending.push(data);
+                self.requestData();
+                return;
+            }
+            self.apply(data);
+        };
+
+        self.onStartupComplete = self.requestData;
+        self.onUserLoggedIn = self.requestData;
+        self.onServerReconnect = self.requestData;
+
+        // Text shown for each heater
+        self.temps = function(heater) {
+            var current = heater.current();
+            var set = heater.set();
+            if (current === null) {
+                return "-";
+            }
+            return current.toFixed(1) + "°C" + (set !== null && set > 0 ? " / " + set.toFixed(1) + "°C" : "");
+        };
+
+        // How far the heater is from leaving min/max
+        self.margin = function(heater) {
+            var current = heater.current();
+            var min = heater.min();
+            var max = heater.max();
+            if (current === null || max === null) {
+                return "-";
+            }
+            var margin = heater.set() > 0 && min !== null ? Math.min(current - min, max - current) : max - current;
+            return margin.toFixed(1) + "°C";
+        };
+
+        self.countdown = function(heater) {
+            var tripAt = heater.tripAt();
+            if (tripAt === null) {
+                return "";
+            }
+            var left = Math.max(0, tripAt - (self.now() + self.offset));
+            return left.toFixed(0) + "s";
+        };
+
+        self.stateText = function(heater) {
+            switch (heater.state()) {
+                case "tripped": return gettext("Thermal Runaway");
+                case "low": return gettext("Too low");
+                case "high": return gettext("Too high");
+                case "rate": return gettext("Rate of change");
+                case "model": return gettext("Unexpected");
+                case "ok": return gettext("OK");
+                default: return gettext("Off");
+            }
+        };
+
+        self.canReset = ko.pureComputed(function() {
+            return self.loginState.hasPermission(self.access.permissions.CONTROL);
+        });
+
+        self.reset = function(heater) {
+            OctoPrint.simpleApiCommand("ThermalRunaway", "reset", {heater: heater.name})
+                .fail(function() {
+                    new PNotify({
+                        title: gettext("Thermal Runaway"),
+                        text: _.sprintf(gettext("Couldn't reset %(heater)s"), {heater: heater.name}),
+                        type: "error"
+                    });
+                });
+        };
+
+        self.stateClass = function(heater) {
+            switch (heater.state()) {
+                case "tripped": return "label label-important";
+                case "low":
+                case "high":
+                case "rate":
+                case "model": return "label label-warning";
+                case "ok": return "label label-success";
+                default: return "label";
+            }
+        };
+
+        setInterval(function() {
+            self.now(Date.now() / 1000);
+        }, 1000);
+    }
+
+    OCTOPRINT_VIEWMODELS.push({
+        construct: ThermalRunawayViewModel,
+        dependencies: ["loginStateViewModel", "accessViewModel"],
+        elements: ["#sidebar_plugin_ThermalRunaway"]
+    });
+});
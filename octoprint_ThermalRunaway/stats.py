@@ -0,0 +1,39 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+# Import bisect. Used to find the bucket a value falls into
+import bisect
+
+# Upper bounds in seconds of the buckets used for timings, from 10us to 1s
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+                   0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+class LatencyHistogram(object):
+    # Fixed bucket histogram of timings. Only ever written from one thread, readers take a copy with snapshot()
+    __slots__ = ('bounds', 'counts', 'count', 'sum', 'max')
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # The last bucket is for anything above the highest bound
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    # Record a timing in seconds
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    # Copy of the histogram as a dict, with cumulative bucket counts keyed by upper bound the way Prometheus wants them
+    def snapshot(self):
+        counts = list(self.counts)
+        buckets = []
+        total = 0
+        for bound, count in zip(self.bounds + ('+Inf',), counts):
+            total += count
+            buckets.append((bound, total))
+        return dict(count=total, sum=self.sum, max=self.max, buckets=buckets)
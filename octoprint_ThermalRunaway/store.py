@@ -0,0 +1,271 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+# Append-only binary history of every report for every heater, kept in the plugin data folder.
+#
+# Each heater has its own files, history/<heater>-<sequence>.bin, each a short header followed by fixed width records
+# of (time, current, set, state). The evaluator only adds the record to an in-memory queue, a background thread
+# packs and writes them out in batches. A file is closed and a new one started once it reaches the size limit, and the
+# oldest files are deleted to keep the number of files per heater down. Reads map the files rather than loading
+# them, and find where to start with a binary search on the record times.
+#
+# Only whole records are ever read, so a record half written when OctoPrint was killed is ignored, and cut off the
+# end of the file before anything else is appended to it.
+
+# Import collections. Records waiting to be written are kept in a deque for each heater
+import collections
+# Import mmap. Used to read the files without loading them
+import mmap
+# Import os. Used to manage the files
+import os
+# Import re. Used to find the files in the history folder
+import re
+# Import struct. Records are packed into a fixed width binary format
+import struct
+# Import threading. Used for the flusher thread
+import threading
+
+# File header: magic, format version, size of each record
+HEADER = struct.Struct('<4sHH8x')
+MAGIC = b'TRHS'
+VERSION = 1
+# Record: time received, current temp, set temp, state flags
+RECORD = struct.Struct('<dffB3x')
+
+# State flags stored with each record
+STATE_WARNING_LOW = 1  # Below min
+STATE_WARNING_HIGH = 2  # Above max
+STATE_WARNING_RATE = 4  # Rate of change looks like a runaway
+STATE_WARNING_MODEL = 8  # Heading out of min/max when its model says it shouldn't be
+STATE_TRIPPED = 16  # Caught as a thermal runaway
+
+FILE_PATTERN = re.compile(r'^(?P<heater>[A-Za-z0-9_]+)-(?P<sequence>\d+)\.bin$')
+
+
+# State flags for a HeaterState
+def heater_state(heater):
+    state = 0
+    if heater.warningLow:
+        state |= STATE_WARNING_LOW
+    if heater.warningHigh:
+        state |= STATE_WARNING_HIGH
+    if heater.rateWarning:
+        state |= STATE_WARNING_RATE
+    if heater.modelWarning:
+        state |= STATE_WARNING_MODEL
+    if heater.tripped:
+        state |= STATE_TRIPPED
+    return state
+
+
+# Unpack the records in buffer from byte offset start up to end, as a list of (time, current, set, state)
+def _unpack(buffer, start, end):
+    return [RECORD.unpack_from(buffer, offset)[:4] for offset in range(start, end, RECORD.size)]
+
+
+class HistoryStore(object):
+    # Records are kept in time order as they arrive, reads assume the times only ever go up
+    def __init__(self, folder, logger, maxFileSize=4 * 1024 * 1024, maxFiles=4, flushInterval=1.0,
+                 maxPending=65536):
+        self.folder = folder
+        self.logger = logger
+        self.maxFileSize = maxFileSize  # A new file is started once the current one reaches this many bytes
+        self.maxFiles = maxFiles  # Number of files kept for each heater, the oldest is deleted when a new one starts
+        self.flushInterval = flushInterval  # Seconds between writes
+        self.maxPending = maxPending  # Records held for each heater before they are dropped, in case writes stall
+
+        # heater -> deque of records waiting to be written. Only the evaluator appends and only the flusher pops,
+        # deques are safe for that without a lock
+        self._pending = {}
+        self._files = {}  # heater -> (sequence, open file) being appended to
+        self._wake = threading.Event()
+        self._running = False
+        self._thread = None
+
+        # Counters
+        self.written = 0  # Records written to disk
+        self.dropped = 0  # Records dropped because they couldn't be written fast enough
+        self.failed = 0  # Writes that raised an exception
+
+    # Queue a record for a heater, called from the evaluator for every report
+    def record(self, heater, time, current, setTemp, state):
+        pending = self._pending.get(heater)
+        if pending is None:
+            pending = self._pending[heater] = collections.deque()
+        if len(pending) >= self.maxPending:
+            self.dropped += 1
+            return
+        pending.append((time, current, setTemp, state))
+
+    # Queue a record for a HeaterState
+    def record_heater(self, heater):
+        self.record(heater.name, heater.received, heater.current, heater.set, heater_state(heater))
+
+    # Start the flusher thread, does nothing if it is already running
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="ThermalRunaway history")
+        self._thread.daemon = True
+        self._thread.start()
+
+    # Stop the flusher thread, write out anything still waiting and close the files
+    def stop(self, timeout=2.0):
+        self._running = False
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        self.flush()
+        files, self._files = self._files, {}
+        for sequence, historyFile in files.values():
+            historyFile.close()
+
+    def _run(self):
+        while self._running:
+            self._wake.wait(self.flushInterval)
+            self._wake.clear()
+            self.flush()
+
+    # Write out every record waiting to be written, one write per heater
+    def flush(self):
+        pack = RECORD.pack
+        for heater, pending in list(self._pending.items()):
+            count = len(pending)
+            if not count:
+                continue
+            popleft = pending.popleft
+            records = b''.join([pack(*popleft()) for i in range(0, count)])
+            try:
+                self._write(heater, records)
+                self.written += count
+            except Exception as e:
+                # Log that something went wrong, the records are lost but the next batch is tried again
+                self.failed += 1
+                self.logger.exception("Exception while writing history for {}: {}".format(heater, e))
+
+    # Append packed records to a heater's files, starting new files as each one fills up
+    def _write(self, heater, records):
+        sequence, historyFile = self._files.get(heater, (None, None))
+        if historyFile is None:
+            sequence, historyFile = self._open(heater)
+        start = 0
+        while start < len(records):
+            room = (self.maxFileSize - historyFile.tell()) // RECORD.size * RECORD.size
+            if room <= 0:
+                historyFile.close()
+                sequence, historyFile = self._new_file(heater, sequence + 1)
+                self._files[heater] = (sequence, historyFile)
+                # Always at least one record per file, however small the limit
+                room = max(RECORD.size, (self.maxFileSize - HEADER.size) // RECORD.size * RECORD.size)
+            historyFile.write(records[start:start + room])
+            start += room
+        historyFile.flush()
+        self._files[heater] = (sequence, historyFile)
+
+    # Open the newest file for a heater to append to, or start a new one if there isn't one
+    def _open(self, heater):
+        sequences = self._sequences(heater)
+        if not sequences:
+            return self._new_file(heater, 0)
+
+        sequence = sequences[-1]
+        path = self._path(heater, sequence)
+        historyFile = open(path, 'r+b')
+        header = historyFile.read(HEADER.size)
+        if len(header) != HEADER.size or HEADER.unpack(header) != (MAGIC, VERSION, RECORD.size):
+            # Not a file we can append to, leave it alone and start the next one
+            historyFile.close()
+            self.logger.warning('Not appending to %s, it is not a history file this version can write', path)
+            return self._new_file(heater, sequence + 1)
+
+        # Cut off a record that was only partly written, so that the records stay aligned
+        size = historyFile.seek(0, os.SEEK_END)
+        whole = HEADER.size + (size - HEADER.size) // RECORD.size * RECORD.size
+        if whole != size:
+            self.logger.warning('Removing %s bytes of partly written history from the end of %s', size - whole, path)
+            historyFile.truncate(whole)
+            historyFile.seek(whole)
+        return sequence, historyFile
+
+    # Start a new file for a heater, deleting the oldest files if there are too many
+    def _new_file(self, heater, sequence):
+        historyFile = open(self._path(heater, sequence), 'wb')
+        historyFile.write(HEADER.pack(MAGIC, VERSION, RECORD.size))
+        historyFile.flush()
+        for old in self._sequences(heater)[:-self.maxFiles]:
+            try:
+                os.remove(self._path(heater, old))
+            except OSError as e:
+                # Probably being read, it'll be tried again when the next file is started
+                self.logger.debug('Could not remove old history file: %s', e)
+        return sequence, historyFile
+
+    def _path(self, heater, sequence):
+        return os.path.join(self.folder, '{}-{:06d}.bin'.format(heater, sequence))
+
+    # Sequence numbers of the files for a heater, oldest first
+    def _sequences(self, heater):
+        sequences = []
+        if os.path.isdir(self.folder):
+            for name in os.listdir(self.folder):
+                match = FILE_PATTERN.match(name)
+                if match is not None and match.group('heater') == heater:
+                    sequences.append(int(match.group('sequence')))
+        return sorted(sequences)
+
+    # Records for a heater received at or after since, oldest first, as a list of (time, current, set, state).
+    # Includes records that haven't been written yet
+    def read(self, heater, since):
+        # Copied before the files are read. Anything the flusher writes out in between is in both, and only the copy
+        # from the file is kept
+        pending = list(self._pending.get(heater, ()))
+
+        chunks = []
+        for sequence in reversed(self._sequences(heater)):
+            records, complete = self._read_file(self._path(heater, sequence), since)
+            chunks.append(records)
+            if complete:
+                # This file goes back far enough, the older ones aren't needed
+                break
+        chunks.reverse()
+
+        result = [record for records in chunks for record in records]
+        newest = result[-1][0] if result else float('-inf')
+        result.extend(record for record in pending if record[0] >= since and record[0] > newest)
+        return result
+
+    # Read the records at or after since from one file. Returns the records, and whether the file starts at or before
+    # since, so that older files don't need to be read
+    def _read_file(self, path, since):
+        try:
+            with open(path, 'rb') as historyFile:
+                size = os.fstat(historyFile.fileno()).st_size
+                count = (size - HEADER.size) // RECORD.size
+                if count <= 0:
+                    return [], False
+                mapped = mmap.mmap(historyFile.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            # Deleted or emptied since the folder was listed
+            return [], False
+
+        try:
+            if HEADER.unpack_from(mapped, 0) != (MAGIC, VERSION, RECORD.size):
+                return [], False
+            end = HEADER.size + count * RECORD.size
+
+            # Binary search for the first record at or after since
+            low, high = 0, count
+            while low < high:
+                middle = (low + high) // 2
+                if RECORD.unpack_from(mapped, HEADER.size + middle * RECORD.size)[0] < since:
+                    low = middle + 1
+                else:
+                    high = middle
+            return (_unpack(mapped, HEADER.size + low * RECORD.size, end),
+                    RECORD.unpack_from(mapped, HEADER.size)[0] <= since)
+        finally:
+            mapped.close()
@@ -0,0 +1,120 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+# Import threading. Used for the watchdog thread
+import threading
+# Import time. Reports are stamped with time.time(), so that is what they are checked against
+import time
+
+
+class StaleWatchdog(object):
+    # Catches the temperature reports stopping while a heater is turned on. The checks only run when a report is
+    # evaluated, so if the firmware stops reporting, the serial link stalls or OctoPrint's comm thread hangs nothing
+    # would be checked at all.
+    #
+    # Nothing is done per report: the engine already stores the time each heater was last reported. A single thread
+    # sleeps until the oldest report from a heater that is turned on would go stale, looks at the heaters then, and
+    # goes back to sleep until the next one could. While the reports keep coming that is one wake-up every `timeout`
+    # seconds, however many heaters there are.
+    #
+    # on_stale is called with (heater, seconds since its last report) for the heater that has gone the longest without
+    # a report, once each time the reports stop. It is called again only after the reports have started again
+    def __init__(self, engine, logger, on_stale, timeout=60.0, clock=time.time):
+        self.engine = engine
+        self.logger = logger
+        self.on_stale = on_stale
+        self.timeout = timeout  # Seconds without a report before a heater that is turned on is stale
+        self.clock = clock
+
+        # Reports received before this time are ignored, so that disconnecting the printer isn't taken for a stall
+        self.disarmedAt = 0.0
+        # True once on_stale has been called, until the reports start again
+        self.stale = False
+
+        # Counters
+        self.fired = 0  # Number of times the reports have gone stale
+        self.checks = 0  # Number of times the heaters have been looked at
+        self.lastStale = None  # Time the reports last went stale
+
+        self._wake = threading.Event()
+        self._running = False
+        self._thread = None
+
+    # Ignore the reports received so far, used when the printer is disconnected. The heaters are watched again from
+    # their next report
+    def disarm(self):
+        self.disarmedAt = self.clock()
+        self.stale = False
+        self.wake()
+
+    # Look at the heaters at time now. Calls on_stale if the reports have gone stale, and returns the number of
+    # seconds until they next could
+    def check(self, now=None):
+        if now is None:
+            now = self.clock()
+        self.checks += 1
+        timeout = self.timeout
+        oldest = None
+        for heater in list(self.engine.heaters):
+            # Only heaters that are turned on, have been reported since the printer connected and haven't already
+            # been caught as a thermal runaway
+            if heater.set > 0.0 and not heater.tripped and heater.received >= self.disarmedAt:
+                if oldest is None or heater.received < oldest.received:
+                    oldest = heater
+
+        if oldest is None or now - oldest.received < timeout:
+            # Nothing on, or still reporting
+            self.stale = False
+            return timeout if oldest is None else oldest.received + timeout - now
+
+        if not self.stale:
+            self.stale = True
+            self.fired += 1
+            self.lastStale = now
+            try:
+                self.on_stale(oldest, now - oldest.received)
+            except Exception as e:
+                self.logger.exception("Exception while handling stale temperature reports: {}".format(e))
+        # Already handled, check again in a while in case the reports come back
+        return timeout
+
+    # Start the watchdog thread, does nothing if it is already running
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="ThermalRunaway watchdog")
+        self._thread.daemon = True
+        self._thread.start()
+
+    # Stop the watchdog thread
+    def stop(self, timeout=2.0):
+        self._running = False
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    # Wake the thread up to check straight away, used when the timeout has changed
+    def wake(self):
+        self._wake.set()
+
+    def _run(self):
+        while self._running:
+            try:
+                delay = self.check()
+            except Exception as e:
+                self.logger.exception("Exception in the stale report watchdog: {}".format(e))
+                delay = self.timeout
+            # Never spin, however close the next deadline is
+            self._wake.wait(max(0.1, delay))
+            self._wake.clear()
+
+    def stats(self):
+        return dict(
+            stale=self.stale,
+            fired=self.fired,
+            checks=self.checks,
+            lastStale=self.lastStale,
+            timeout=self.timeout
+        )
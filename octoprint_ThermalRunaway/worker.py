@@ -0,0 +1,113 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+# Import collections. OrderedDict keeps the pending reports in the order the heaters were first seen
+import collections
+# Import threading. This is used for the evaluator thread and to hand reports over to it
+import threading
+# Import time. Used to time each evaluation
+import time
+
+from .stats import LatencyHistogram
+
+
+class ReportQueue(object):
+    # Bounded queue that only ever holds the latest report for each heater. A report for a heater that is still waiting
+    # to be evaluated replaces the older one (coalesced), a report for a new heater is dropped if the queue is full
+    def __init__(self, maxHeaters=32):
+        self.maxHeaters = maxHeaters
+        self._pending = collections.OrderedDict()
+        self._condition = threading.Condition(threading.Lock())
+
+        # Counters so that we can tell how far behind the evaluator is running
+        self.received = 0
+        self.coalesced = 0
+        self.dropped = 0
+        # Longest time between two reports from OctoPrint
+        self.lastReceived = None
+        self.maxGap = 0.0
+
+    # Store a temperature report as received from OctoPrint, along with the time it was received
+    def put(self, temps, receivedAt):
+        with self._condition:
+            self.received += 1
+            if self.lastReceived is not None and receivedAt - self.lastReceived > self.maxGap:
+                self.maxGap = receivedAt - self.lastReceived
+            self.lastReceived = receivedAt
+            for heater, values in temps.items():
+                if heater in self._pending:
+                    # Older report for this heater hasn't been evaluated yet, replace it with the newer one
+                    self.coalesced += 1
+                elif len(self._pending) >= self.maxHeaters:
+                    # Queue is full, drop the report for this heater
+                    self.dropped += 1
+                    continue
+                self._pending[heater] = (values[0], values[1], receivedAt)
+            self._condition.notify()
+
+    # Wait for pending reports and return all of them, keyed by heater
+    def get(self, timeout=None):
+        with self._condition:
+            if not self._pending:
+                self._condition.wait(timeout)
+            batch = self._pending
+            self._pending = collections.OrderedDict()
+            return batch
+
+    # Wake up anything waiting in get() without adding a report
+    def wake(self):
+        with self._condition:
+            self._condition.notify_all()
+
+
+class EvaluationWorker(object):
+    # Long-lived thread that takes reports off a ReportQueue and passes them to the evaluate callback
+    def __init__(self, reportQueue, evaluate, logger):
+        self.reportQueue = reportQueue
+        self.evaluate = evaluate
+        self.logger = logger
+
+        # Number of batches that have been evaluated, and how many of those raised an exception
+        self.evaluated = 0
+        self.failed = 0
+        # How long each batch took to evaluate, and how long it waited in the queue before that
+        self.latency = LatencyHistogram()
+        self.queueDelay = LatencyHistogram()
+
+        self._running = False
+        self._thread = None
+
+    # Start the evaluator thread, does nothing if it is already running
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="ThermalRunaway evaluator")
+        self._thread.daemon = True
+        self._thread.start()
+
+    # Ask the evaluator thread to stop and wait for it to finish
+    def stop(self, timeout=2.0):
+        self._running = False
+        self.reportQueue.wake()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        while self._running:
+            batch = self.reportQueue.get(timeout=1.0)
+            if not batch or not self._running:
+                continue
+            started = time.time()
+            self.queueDelay.observe(max(0.0, started - min(values[2] for values in batch.values())))
+            started = time.perf_counter()
+            try:
+                self.evaluate(batch)
+            except Exception as e:
+                # Log that something went wrong, and keep the thread alive for the next report
+                self.failed += 1
+                self.logger.exception("Exception while evaluating temps: {}".format(e))
+            finally:
+                self.latency.observe(time.perf_counter() - started)
+                self.evaluated += 1
@@ -59,7 +59,15 @@ plugin_ignored_packages = []
 # Example:
 #     plugin_requires = ["someDependency==dev"]
 #     additional_setup_parameters = {"dependency_links": ["https://github.com/someUser/someRepo/archive/master.zip#egg=someDependency-dev"]}
-additional_setup_parameters = {}
+additional_setup_parameters = {
+	"python_requires": ">=3.7,<4",
+	"entry_points": {
+		"console_scripts": [
+			"thermalrunaway-replay = octoprint_ThermalRunaway.replay:main",
+			"thermalrunaway-companion = octoprint_ThermalRunaway.companion:main"
+		]
+	}
+}
 
 ########################################################################################################################
 